@@ -1,49 +1,136 @@
 from __future__ import annotations
 from typing import Dict, Any
 from datetime import datetime
+import functools
+import importlib
+import logging
+import os
+import time
 
-# Very simple in-memory analytics per user_id
-# For production use a database or Redis
+# Simple per-user analytics. Counters live in Redis when ANALYTICS_REDIS_URL is
+# set (shared across workers, survives restarts); otherwise in-process memory.
+# The Redis calls block on the network, so async handlers run them in the threadpool.
+
+logger = logging.getLogger("app.analytics")
+
+_redis: Any | None = None
+_REDIS_URL = os.getenv("ANALYTICS_REDIS_URL")
+# seconds; an unreachable Redis costs one short wait per event, then the memory fallback
+_REDIS_TIMEOUT = 0.5
+if _REDIS_URL:
+    try:
+        _redis_mod: Any = importlib.import_module("redis")
+        _redis = _redis_mod.Redis.from_url(
+            _REDIS_URL,
+            decode_responses=True,
+            socket_timeout=_REDIS_TIMEOUT,
+            socket_connect_timeout=_REDIS_TIMEOUT,
+        )
+    except Exception:
+        _redis = None
+
+_COUNTERS = ("queries", "llm_queries", "uploads", "sessions")
+
+
+class UserStats:
+    __slots__ = ("user_id", "first_seen", "last_seen", "queries", "llm_queries", "uploads", "sessions")
+
+    def __init__(self, user_id: str, now: str) -> None:
+        self.user_id = user_id
+        self.first_seen = now
+        self.last_seen = now
+        self.queries = 0
+        self.llm_queries = 0
+        self.uploads = 0
+        self.sessions = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+_analytics: Dict[str, UserStats] = {}
+
+@functools.lru_cache(maxsize=2)
+def _iso_for_second(sec: int) -> str:
+    return datetime.utcfromtimestamp(sec).isoformat() + "Z"
 
-_analytics: Dict[str, Dict[str, Any]] = {}
 
 def _now_iso() -> str:
-    return datetime.utcnow().isoformat() + "Z"
+    # Seconds granularity is enough for last_seen; events within the same
+    # second share one cached string instead of formatting a new datetime.
+    return _iso_for_second(int(time.time()))
+
+
+def _redis_key(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def _redis_record(user_id: str, now: str, **incr: int) -> bool:
+    """Apply counter increments in one pipeline. Returns False if Redis is unavailable."""
+    if _redis is None:
+        return False
+    key = _redis_key(user_id)
+    try:
+        pipe = _redis.pipeline()
+        pipe.hsetnx(key, "user_id", user_id)
+        pipe.hsetnx(key, "first_seen", now)
+        for field, n in incr.items():
+            if n:
+                pipe.hincrby(key, field, n)
+        pipe.hset(key, "last_seen", now)
+        pipe.execute()
+        return True
+    except Exception:
+        logger.warning("Redis analytics write failed; using in-memory store", exc_info=True)
+        return False
 
 
-def ensure_user(user_id: str) -> Dict[str, Any]:
-    if user_id not in _analytics:
-        _analytics[user_id] = {
-            "user_id": user_id,
-            "first_seen": _now_iso(),
-            "last_seen": _now_iso(),
-            "queries": 0,
-            "llm_queries": 0,
-            "uploads": 0,
-            "sessions": 0,
-        }
-    return _analytics[user_id]
+def ensure_user(user_id: str, now: str | None = None) -> UserStats:
+    u = _analytics.get(user_id)
+    if u is None:
+        u = _analytics[user_id] = UserStats(user_id, now or _now_iso())
+    return u
 
 
 def record_session(user_id: str) -> None:
-    u = ensure_user(user_id)
-    u["sessions"] += 1
-    u["last_seen"] = _now_iso()
+    now = _now_iso()
+    if _redis_record(user_id, now, sessions=1):
+        return
+    u = ensure_user(user_id, now)
+    u.sessions += 1
+    u.last_seen = now
 
 
 def record_query(user_id: str, llm_used: bool) -> None:
-    u = ensure_user(user_id)
-    u["queries"] += 1
+    now = _now_iso()
+    if _redis_record(user_id, now, queries=1, llm_queries=1 if llm_used else 0):
+        return
+    u = ensure_user(user_id, now)
+    u.queries += 1
     if llm_used:
-        u["llm_queries"] += 1
-    u["last_seen"] = _now_iso()
+        u.llm_queries += 1
+    u.last_seen = now
 
 
 def record_upload(user_id: str) -> None:
-    u = ensure_user(user_id)
-    u["uploads"] += 1
-    u["last_seen"] = _now_iso()
+    now = _now_iso()
+    if _redis_record(user_id, now, uploads=1):
+        return
+    u = ensure_user(user_id, now)
+    u.uploads += 1
+    u.last_seen = now
 
 
 def get_profile(user_id: str) -> Dict[str, Any]:
-    return ensure_user(user_id)
+    if _redis is not None:
+        try:
+            h = _redis.hgetall(_redis_key(user_id))
+            if h:
+                out = UserStats(user_id, h.get("first_seen") or _now_iso()).to_dict()
+                out["last_seen"] = h.get("last_seen") or out["first_seen"]
+                for field in _COUNTERS:
+                    out[field] = int(h.get(field) or 0)
+                return out
+        except Exception:
+            logger.warning("Redis analytics read failed; using in-memory store", exc_info=True)
+    return ensure_user(user_id).to_dict()
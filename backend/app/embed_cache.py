@@ -0,0 +1,62 @@
+import hashlib
+import importlib
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List
+
+import numpy as np
+
+# Content-addressed embedding cache on disk.
+# Vectors are stored as raw float32 bytes in SQLite, keyed by a hash of
+# (model key, text), so re-ingesting the same document or rebuilding the index
+# after a delete only runs the model on texts it has not seen before.
+
+_blake3: Any | None = None
+try:
+    _blake3 = importlib.import_module("blake3").blake3
+except Exception:
+    _blake3 = None
+
+# SQLite caps the number of bound parameters per statement
+_SQL_BATCH = 500
+
+
+def content_key(data: str) -> str:
+    raw = data.encode("utf-8")
+    if _blake3 is not None:
+        return _blake3(raw).hexdigest()
+    return hashlib.blake2b(raw, digest_size=32).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        # shared by ingest threads that encode outside the index lock; _lock serializes them
+        self._db = sqlite3.connect(os.path.join(path, "embeddings.sqlite"), check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS emb (k TEXT PRIMARY KEY, v BLOB NOT NULL)")
+        self._db.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        uniq = list(dict.fromkeys(keys))
+        for i in range(0, len(uniq), _SQL_BATCH):
+            part = uniq[i:i + _SQL_BATCH]
+            with self._lock:
+                rows = self._db.execute(
+                    f"SELECT k, v FROM emb WHERE k IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+            for k, v in rows:
+                found[k] = np.frombuffer(v, dtype=np.float32)
+        return found
+
+    def put_many(self, keys: List[str], embeddings: np.ndarray) -> None:
+        emb = np.asarray(embeddings, dtype=np.float32)
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO emb (k, v) VALUES (?, ?)",
+                ((k, e.tobytes()) for k, e in zip(keys, emb)),
+            )
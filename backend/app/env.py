@@ -0,0 +1,21 @@
+import os
+
+# Environment parsing shared by the app modules. Malformed values fall back to the
+# default instead of failing at import.
+
+
+def int_env(key: str, default: int) -> int:
+    try:
+        return int(os.getenv(key, str(default)))
+    except Exception:
+        return default
+
+
+def flag_env(key: str, default: bool) -> bool:
+    """Boolean switch: on-by-default flags are disabled by 0/false, off-by-default ones enabled by 1/true."""
+    value = os.getenv(key)
+    if value is None:
+        return default
+    if default:
+        return value not in ("0", "false", "False")
+    return value in ("1", "true", "True")
@@ -1,12 +1,21 @@
 import os
 import re
 import logging
-from typing import List, Optional, Literal
+import functools
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Literal
+
+from .env import int_env
 
 _HAS_OPENAI = False
 _HAS_OPENAI_V1 = False
-_openai_client = None
-_openai_api_key_cache: str | None = None
+# One client per API key (small LRU) so switching keys reuses connection pools
+_OPENAI_CLIENTS_MAX = 16
+_openai_clients: "OrderedDict[str | None, Any]" = OrderedDict()
+_openai_clients_lock = threading.Lock()
 
 logger = logging.getLogger("app.llm")
 
@@ -26,19 +35,110 @@ except Exception:
         _HAS_OPENAI = False
         _HAS_OPENAI_V1 = False
 
+# Rate-limit detection on provider error messages
+_RL_MARKER = re.compile(r"rate[_ ]limit", re.IGNORECASE)
+_RATE_LIMIT_RE = re.compile(r"try again in ([0-9]+m)?([0-9]+(?:\.[0-9]+)?s)")
+
 PROMPT_TEMPLATE = (
     "You are an assistant. Use the provided context chunks to answer the question as accurately and concisely.\n\n"
     "Context:\n{context}\n\nQuestion: {question}\n\nAnswer:"
 )
 
 
+# Persona presets to influence tone & format. Built once at import; the system
+# message dicts are shared across requests and must not be mutated.
+_PERSONA_PROMPTS: dict[str, dict] = {
+    "bullets": {
+        "role": "system",
+        "content": (
+            "You are a helpful, professional assistant for a RAG system. Use ONLY the provided context below (which was extracted from the user's uploaded PDFs). "
+            "Never say that you cannot access or analyze uploaded files; treat the provided context as the relevant excerpts. "
+            "Answer briefly using 3-6 bullet points. Each bullet should be a short sentence. "
+            "Cite sources inline with [n] matching the numbered context entries. "
+            "If the question is broad (e.g., 'tell me about my PDF'), provide a concise summary using the context. "
+            "If context is incomplete, say what's missing and ask a targeted follow-up. Do not invent facts beyond the context."
+        ),
+    },
+    "step-by-step": {
+        "role": "system",
+        "content": (
+            "You are a friendly tutor for a RAG system. Use ONLY the provided context below (excerpts from uploaded PDFs). "
+            "Never say you cannot read or access files; you can use the provided context. "
+            "Explain step-by-step in clear, numbered steps (3-7 steps). Keep each step concise. "
+            "Cite sources inline with [n] where relevant. Indicate uncertainty if context is thin, and suggest a follow-up if needed."
+        ),
+    },
+    "formal": {
+        "role": "system",
+        "content": (
+            "You are a formal, professional assistant for a RAG system. Use ONLY the provided context below (from uploaded PDFs). "
+            "Never claim inability to access files; rely on the provided context. "
+            "Respond in 2-5 compact sentences. Maintain a neutral tone. "
+            "Include inline citations with [n]. Acknowledge uncertainty if needed."
+        ),
+    },
+    # default
+    "concise": {
+        "role": "system",
+        "content": (
+            "You are a helpful assistant for a RAG system. Use ONLY the provided context below (extracted from the user's uploaded PDFs). "
+            "Do NOT say you cannot access or analyze uploaded files; treat the provided context as the accessible content. "
+            "If the user asks generally about their PDF, summarize it using the context. "
+            "Answer succinctly in 2-5 sentences or short bullets. "
+            "Cite sources inline with [n] matching the numbered context entries. "
+            "If information is incomplete, give the best answer you can using the most relevant context and note uncertainties. "
+            "Do not invent facts beyond the context."
+        ),
+    },
+}
+
+
+_KNOWN_PERSONAS = frozenset(_PERSONA_PROMPTS)
+
+
+@functools.lru_cache(maxsize=2)
+def _default_model(fallback: str = 'gpt-3.5-turbo-0125') -> str:
+    return os.getenv('OPENAI_MODEL', fallback)
+
+
+@functools.lru_cache(maxsize=1)
+def _per_chunk_limit() -> int:
+    return int_env("RAG_CONTEXT_CHARS_PER_CHUNK", 800)
+
+
+@functools.lru_cache(maxsize=1)
+def _max_context_chars() -> int:
+    return int_env("RAG_CONTEXT_MAX_CHARS", 5000)
+
+
+def _env_key() -> str | None:
+    # a single dict lookup, so setting or rotating the key at runtime (e.g. a .env
+    # reload) takes effect on the next call; results derived from it are keyed on it
+    return os.environ.get('OPENAI_API_KEY') or None
+
+
+def _llm_enabled() -> bool:
+    return _HAS_OPENAI and _env_key() is not None
+
+
+def reset_env_cache() -> None:
+    """Forget cached env-derived settings (e.g., after changing os.environ in tests)."""
+    _default_model.cache_clear()
+    llm_status.cache_clear()  # type: ignore[attr-defined]
+    ping_llm.cache_clear()  # type: ignore[attr-defined]
+    _per_chunk_limit.cache_clear()
+    _max_context_chars.cache_clear()
+
+
 def _ensure_client(api_key: str | None):
-    global _openai_client, _openai_api_key_cache
     if not _HAS_OPENAI:
         return None
     if _HAS_OPENAI_V1:
-        # Recreate client if missing or API key changed
-        if _openai_client is None or _openai_api_key_cache != api_key:
+        with _openai_clients_lock:
+            client = _openai_clients.get(api_key)
+            if client is not None:
+                _openai_clients.move_to_end(api_key)
+                return client
             # Allow optional organization/project for newer key types
             org = os.getenv('OPENAI_ORG') or os.getenv('OPENAI_ORGANIZATION') or os.getenv('OPENAI_ORG_ID')
             project = os.getenv('OPENAI_PROJECT') or os.getenv('OPENAI_PROJECT_ID')
@@ -47,9 +147,11 @@ def _ensure_client(api_key: str | None):
                 kwargs["organization"] = org
             if project:
                 kwargs["project"] = project
-            _openai_client = OpenAI(**kwargs)  # type: ignore[name-defined]
-            _openai_api_key_cache = api_key
-        return _openai_client
+            client = OpenAI(**kwargs)  # type: ignore[name-defined]
+            _openai_clients[api_key] = client
+            while len(_openai_clients) > _OPENAI_CLIENTS_MAX:
+                _openai_clients.popitem(last=False)
+        return client
     else:
         # legacy
         if openai is not None and api_key:
@@ -57,14 +159,45 @@ def _ensure_client(api_key: str | None):
         return openai
 
 
+def _ttl_cache(ttl_s: float):
+    """Memoize a model_override -> dict function for ttl_s seconds; force=True bypasses.
+
+    Entries are also keyed on the current OPENAI_API_KEY, so a new key is probed afresh.
+    """
+    def deco(fn):
+        entries: dict = {}
+
+        @functools.wraps(fn)
+        def wrapper(model_override: Optional[str] = None, *, force: bool = False) -> dict:
+            now = time.monotonic()
+            key = (model_override, _env_key())
+            hit = entries.get(key)
+            if not force and hit is not None and now - hit[0] < ttl_s:
+                return dict(hit[1])
+            value = fn(model_override)
+            entries[key] = (now, value)
+            return dict(value)
+
+        wrapper.cache_clear = entries.clear  # type: ignore[attr-defined]
+        return wrapper
+    return deco
+
+
+def warmup_client() -> None:
+    """Construct the SDK client ahead of the first request (no network call)."""
+    if _llm_enabled():
+        _ensure_client(_env_key())
+
+
+@_ttl_cache(5.0)
 def llm_status(model_override: str | None = None) -> dict:
     """Return LLM readiness without making a network call.
     ok: True if SDK present and API key non-empty.
     reason: brief text when not ok.
     model: the model that would be used.
     """
-    model = model_override or os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo-0125')
-    key = os.getenv('OPENAI_API_KEY')
+    model = model_override or _default_model()
+    key = _env_key()
     if not _HAS_OPENAI:
         return {"ok": False, "reason": "OpenAI SDK not installed", "model": model}
     if not key:
@@ -73,14 +206,16 @@ def llm_status(model_override: str | None = None) -> dict:
     return {"ok": True, "reason": None, "model": model}
 
 
+@_ttl_cache(30.0)
 def ping_llm(model_override: Optional[str] = None) -> dict:
     """Attempt a tiny completion to validate API key, model access, and network.
 
     Returns { ok: bool, model: str, reason: Optional[str] } without raising.
     This uses max_tokens=1 and a single-message prompt to minimize token usage.
+    Results are cached for 30s per model; pass force=True to re-probe.
     """
-    key = os.getenv('OPENAI_API_KEY')
-    model = model_override or os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo-0125')
+    key = _env_key()
+    model = model_override or _default_model()
     if not _HAS_OPENAI:
         return {"ok": False, "model": model, "reason": "OpenAI SDK not installed"}
     if not key:
@@ -109,12 +244,16 @@ def ping_llm(model_override: Optional[str] = None) -> dict:
     except Exception as e:
         # Treat rate limits as "connected but limited" so the UI can show a clearer state
         msg = (str(e) or "")[:500]
-        low = msg.lower()
-        if "rate limit" in low or "rate_limit" in low:
+        if _RL_MARKER.search(msg):
             return {"ok": True, "model": model, "reason": f"rate_limited: {msg}"}
         return {"ok": False, "model": model, "reason": msg}
 
 
+def _meta_text(r) -> str:
+    m = r.get('meta') if isinstance(r, dict) else None
+    return m.get('text', '') if isinstance(m, dict) else ''
+
+
 def synthesize_answer(
     question: str,
     retrieved: List[dict],
@@ -125,33 +264,16 @@ def synthesize_answer(
 ) -> dict:
     """Return a dict with 'answer' and 'used_chunks'. If OpenAI is not available, return a simple fallback.
 
-    This function reads OPENAI_API_KEY at call time so loading order of .env doesn't matter.
+    OPENAI_API_KEY is read on every call so loading order of .env (or a later reload) doesn't matter.
     """
-    # build context robustly
-    context_items = []
-    for r in retrieved:
-        meta = r.get('meta') if isinstance(r, dict) else {}
-        if isinstance(meta, dict):
-            text = meta.get('text')
-            if text:
-                context_items.append(f"- {text}")
-                continue
-            # fallback to source or repr of meta
-            src = meta.get('source')
-            if src:
-                context_items.append(f"- source: {src}")
-                continue
-        context_items.append("- (no text)")
-
-    context = "\n\n".join(context_items)
-
-    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-    if _HAS_OPENAI and OPENAI_API_KEY:
-        client = _ensure_client(OPENAI_API_KEY)
+    if _llm_enabled():
+        client = _ensure_client(_env_key())
+        # set by _build_messages; still None in the error path if building them failed
+        metas = None
         try:
+            messages, metas = _build_messages(question, retrieved, persona=persona, history=history)
             if _HAS_OPENAI_V1:
-                messages = _build_messages(question, retrieved, persona=persona, history=history)
-                model = model_override or os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo-0125')
+                model = model_override or _default_model()
                 resp = client.chat.completions.create(  # type: ignore[attr-defined]
                     model=model,
                     messages=messages,
@@ -160,11 +282,10 @@ def synthesize_answer(
                     stream=False,
                 )
                 text = resp.choices[0].message.content or ""
-                return {"answer": text.strip(), "used_chunks": [r.get('meta') for r in retrieved]}
+                return {"answer": text.strip(), "used_chunks": metas}
             else:
                 # legacy ChatCompletion
-                messages = _build_messages(question, retrieved, persona=persona, history=history)
-                model = model_override or os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+                model = model_override or _default_model('gpt-3.5-turbo')
                 resp = client.ChatCompletion.create(  # type: ignore[attr-defined]
                     model=model,
                     messages=messages,
@@ -172,25 +293,27 @@ def synthesize_answer(
                     max_tokens=max_tokens,
                 )
                 text = resp["choices"][0]["message"]["content"]
-                return {"answer": (text or "").strip(), "used_chunks": [r.get('meta') for r in retrieved]}
+                return {"answer": (text or "").strip(), "used_chunks": metas}
         except Exception as e:
             # Graceful fallback on OpenAI errors (e.g., invalid key)
             try:
                 logger.exception("LLM non-streaming call failed: %s", e)
             except Exception:
                 pass
-            joined = "\n\n".join([ (r.get('meta') or {}).get('text','') if isinstance(r.get('meta'), dict) else '' for r in retrieved ])
+            joined = "\n\n".join(_meta_text(r) for r in retrieved)
             reason = (str(e)[:200] if e else "")
             prefix = "(LLM unavailable or misconfigured)"
             if reason:
                 prefix = f"(LLM error: {reason})"
             answer = f"{prefix} Showing retrieved context only.\n\n{joined}"
-            return {"answer": answer, "used_chunks": [r.get('meta') for r in retrieved]}
+            if metas is None:
+                metas = tuple(r.get('meta') for r in retrieved)
+            return {"answer": answer, "used_chunks": metas}
 
     # simple fallback: join top-k chunk texts
-    joined = "\n\n".join([ (r.get('meta') or {}).get('text','') if isinstance(r.get('meta'), dict) else '' for r in retrieved ])
+    joined = "\n\n".join(_meta_text(r) for r in retrieved)
     answer = f"(LLM unavailable) Context summary:\n{joined}\n\nQuestion: {question}"
-    return {"answer": answer, "used_chunks": [r.get('meta') for r in retrieved]}
+    return {"answer": answer, "used_chunks": tuple(r.get('meta') for r in retrieved)}
 
 
 def _build_messages(
@@ -202,62 +325,34 @@ def _build_messages(
 ):
     # Enumerate context so the model can cite with [n].
     # Control prompt size to avoid excessive tokens and rate-limit spikes.
-    per_chunk_limit = int(os.getenv("RAG_CONTEXT_CHARS_PER_CHUNK", "800"))
-    max_context_chars = int(os.getenv("RAG_CONTEXT_MAX_CHARS", "5000"))
-    ctx_lines: List[str] = []
-    used = 0
+    per_chunk_limit = _per_chunk_limit()
+    max_context_chars = _max_context_chars()
+    parts: List[tuple] = []
+    # Metas of every retrieved chunk, collected in the same pass for used_chunks
+    metas: List[Any] = []
+    remaining = max_context_chars
+    budget_left = True
     for i, r in enumerate(retrieved, start=1):
-        text = (r.get('meta') or {}).get('text', '') if isinstance(r, dict) else ''
+        meta = r.get('meta') if isinstance(r, dict) else None
+        metas.append(meta)
+        if not budget_left:
+            continue
+        text = (meta or {}).get('text', '') if isinstance(r, dict) else ''
         if not text:
             continue
-        # Trim each chunk and stop when overall budget is reached
-        trimmed = text[:per_chunk_limit]
-        line = f"[{i}] {trimmed}"
-        if used + len(line) > max_context_chars:
-            break
-        ctx_lines.append(line)
-        used += len(line)
-    context = "\n\n".join(ctx_lines)
+        # Trim each chunk (only copying when needed) and stop when overall budget is reached
+        trimmed = text if len(text) <= per_chunk_limit else text[:per_chunk_limit]
+        line_len = len(trimmed) + len(str(i)) + 3  # "[i] " prefix
+        if line_len > remaining:
+            budget_left = False
+            continue
+        parts.append((i, trimmed))
+        remaining -= line_len
+    context = "\n\n".join(f"[{i}] {t}" for i, t in parts)
     # Persona presets to influence tone & format
-    persona = (persona or "concise").lower()
-    if persona == "bullets":
-        tone = (
-            "You are a helpful, professional assistant for a RAG system. Use ONLY the provided context below (which was extracted from the user's uploaded PDFs). "
-            "Never say that you cannot access or analyze uploaded files; treat the provided context as the relevant excerpts. "
-            "Answer briefly using 3-6 bullet points. Each bullet should be a short sentence. "
-            "Cite sources inline with [n] matching the numbered context entries. "
-            "If the question is broad (e.g., 'tell me about my PDF'), provide a concise summary using the context. "
-            "If context is incomplete, say what's missing and ask a targeted follow-up. Do not invent facts beyond the context."
-        )
-    elif persona == "step-by-step":
-        tone = (
-            "You are a friendly tutor for a RAG system. Use ONLY the provided context below (excerpts from uploaded PDFs). "
-            "Never say you cannot read or access files; you can use the provided context. "
-            "Explain step-by-step in clear, numbered steps (3-7 steps). Keep each step concise. "
-            "Cite sources inline with [n] where relevant. Indicate uncertainty if context is thin, and suggest a follow-up if needed."
-        )
-    elif persona == "formal":
-        tone = (
-            "You are a formal, professional assistant for a RAG system. Use ONLY the provided context below (from uploaded PDFs). "
-            "Never claim inability to access files; rely on the provided context. "
-            "Respond in 2-5 compact sentences. Maintain a neutral tone. "
-            "Include inline citations with [n]. Acknowledge uncertainty if needed."
-        )
-    else:  # default: concise
-        tone = (
-            "You are a helpful assistant for a RAG system. Use ONLY the provided context below (extracted from the user's uploaded PDFs). "
-            "Do NOT say you cannot access or analyze uploaded files; treat the provided context as the accessible content. "
-            "If the user asks generally about their PDF, summarize it using the context. "
-            "Answer succinctly in 2-5 sentences or short bullets. "
-            "Cite sources inline with [n] matching the numbered context entries. "
-            "If information is incomplete, give the best answer you can using the most relevant context and note uncertainties. "
-            "Do not invent facts beyond the context."
-        )
-
-    system = {
-        "role": "system",
-        "content": tone,
-    }
+    # Frontend sends lowercase keys; only normalize when needed
+    key = persona if persona in _KNOWN_PERSONAS else (persona or "concise").lower()
+    system = _PERSONA_PROMPTS.get(key, _PERSONA_PROMPTS["concise"])
     user = {
         "role": "user",
         "content": f"Context:\n{context}\n\nQuestion: {question}\nAnswer (with citations):",
@@ -267,13 +362,59 @@ def _build_messages(
     # Optional: include short rolling history before the current user input
     # history format: [{"role": "user"|"assistant", "content": str}, ...]
     if history:
-        for h in history[-10:]:  # keep it small
+        append = messages.append
+        # keep it small: last 10 entries, without copying the list
+        for h in itertools.islice(history, max(0, len(history) - 10), None):
             r = h.get("role")
             c = h.get("content")
-            if r in ("user", "assistant") and isinstance(c, str) and c.strip():
-                messages.append({"role": r, "content": c.strip()})
+            if r in ("user", "assistant") and isinstance(c, str):
+                c = c.strip()
+                if c:
+                    append({"role": r, "content": c})
     messages.append(user)
-    return messages
+    return messages, tuple(metas)
+
+
+_STREAM_FLUSH_CHARS = 32
+_STREAM_FLUSH_ENDINGS = (" ", "\n", ".", ",", "!", "?")
+
+
+def _citation_safe_chunks(deltas):
+    """Re-chunk streamed deltas so citation markers like "[12]" are never split.
+
+    Bracket positions are tracked incrementally per delta instead of rescanning
+    the whole pending buffer, keeping the work linear in the output length.
+    Small deltas are batched until a word boundary or _STREAM_FLUSH_CHARS.
+    """
+    pending = ""
+    last_open = -1
+    last_close = -1
+    for delta in deltas:
+        if not delta:
+            continue
+        base = len(pending)
+        pending += delta
+        pos = delta.rfind("[")
+        if pos >= 0:
+            last_open = base + pos
+        pos = delta.rfind("]")
+        if pos >= 0:
+            last_close = base + pos
+        if last_open > last_close:
+            # hold until we see a closing bracket
+            if last_open > 0:
+                yield pending[:last_open]
+                pending = pending[last_open:]
+                last_open = 0
+                last_close = -1
+        elif len(pending) >= _STREAM_FLUSH_CHARS or pending.endswith(_STREAM_FLUSH_ENDINGS):
+            # coalesce tiny deltas: flush on word/sentence boundaries or once enough text is buffered
+            yield pending
+            pending = ""
+            last_open = -1
+            last_close = -1
+    if pending:
+        yield pending
 
 
 def stream_synthesize_answer(
@@ -285,13 +426,12 @@ def stream_synthesize_answer(
     history: Optional[List[dict]] = None,
 ):
     """Yield chunks of the answer as they are produced by the model. Falls back to single chunk if OpenAI not configured."""
-    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-    if _HAS_OPENAI and OPENAI_API_KEY:
-        client = _ensure_client(OPENAI_API_KEY)
+    if _llm_enabled():
+        client = _ensure_client(_env_key())
         try:
-            messages = _build_messages(question, retrieved, persona=persona, history=history)
+            messages, _ = _build_messages(question, retrieved, persona=persona, history=history)
             if _HAS_OPENAI_V1:
-                model = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo-0125')
+                model = _default_model()
                 if model_override:
                     model = model_override
                 stream = client.chat.completions.create(  # type: ignore[attr-defined]
@@ -301,29 +441,10 @@ def stream_synthesize_answer(
                     max_tokens=max_tokens,
                     stream=True,
                 )
-                pending = ""
-                for chunk in stream:
-                    delta = chunk.choices[0].delta.content or ""
-                    if not delta:
-                        continue
-                    pending += delta
-                    # avoid splitting citation markers like "[12]" across chunks
-                    last_open = pending.rfind("[")
-                    last_close = pending.rfind("]")
-                    if last_open > last_close:
-                        # hold until we see a closing bracket
-                        safe_prefix = pending[:last_open]
-                        if safe_prefix:
-                            yield safe_prefix
-                            pending = pending[last_open:]
-                    else:
-                        yield pending
-                        pending = ""
-                if pending:
-                    yield pending
+                yield from _citation_safe_chunks(chunk.choices[0].delta.content or "" for chunk in stream)
                 return
             else:
-                model = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+                model = _default_model('gpt-3.5-turbo')
                 if model_override:
                     model = model_override
                 stream = client.ChatCompletion.create(  # type: ignore[attr-defined]
@@ -333,24 +454,7 @@ def stream_synthesize_answer(
                     max_tokens=max_tokens,
                     stream=True,
                 )
-                pending = ""
-                for chunk in stream:
-                    delta = chunk["choices"][0]["delta"].get("content", "")
-                    if not delta:
-                        continue
-                    pending += delta
-                    last_open = pending.rfind("[")
-                    last_close = pending.rfind("]")
-                    if last_open > last_close:
-                        safe_prefix = pending[:last_open]
-                        if safe_prefix:
-                            yield safe_prefix
-                            pending = pending[last_open:]
-                    else:
-                        yield pending
-                        pending = ""
-                if pending:
-                    yield pending
+                yield from _citation_safe_chunks(chunk["choices"][0]["delta"].get("content", "") for chunk in stream)
                 return
         except Exception as e:
             # Graceful streaming fallback on OpenAI errors
@@ -360,11 +464,10 @@ def stream_synthesize_answer(
                 pass
             msg = str(e) if e else ""
             if msg:
-                low = msg.lower()
                 # If rate limited, surface a clear, short instruction
-                if "rate limit" in low or "rate_limit" in low:
+                if _RL_MARKER.search(msg):
                     wait_hint = None
-                    m = re.search(r"try again in ([0-9]+m)?([0-9]+(?:\.[0-9]+)?s)", msg)
+                    m = _RATE_LIMIT_RE.search(msg)
                     if m:
                         wait_hint = (m.group(0) or "").replace("try again in ", "")
                     notice = "We are temporarily rate-limited by the LLM provider."
@@ -1,16 +1,24 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import os
+import json
+import heapq
+import time
+import asyncio
 import logging
+from typing import Iterable, Iterator
 
+from .env import flag_env, int_env
 from .rag import RAGIndex
-from .llm import synthesize_answer, llm_status, ping_llm
+from .query_cache import QueryCache
+from .llm import synthesize_answer, llm_status, ping_llm, reset_env_cache, warmup_client
 from .memory import MEMORY
 from .analytics import record_query, record_upload, get_profile
-from .pdf_utils import extract_text_from_pdf_bytes, chunk_text
+from .pdf_utils import extract_text_from_pdf_bytes, iter_pdf_pages, chunk_pages, chunk_text, shutdown_pool
 from fastapi import UploadFile, File
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from .rate_limit import allow as rl_allow
 from fastapi import Request
@@ -20,23 +28,40 @@ from fastapi import Request
 # This avoids confusion when starting uvicorn from different working directories.
 from pathlib import Path
 
+_ENV_CANDIDATES = tuple(
+    p for p in (
+        Path(__file__).resolve().parents[2] / ".env",  # <repo>/.env
+        Path(__file__).resolve().parents[1] / ".env",  # backend/.env
+    )
+    if p.is_file()
+)
+
+
 def _load_envs():
-    root_env = Path(__file__).resolve().parents[2] / ".env"  # <repo>/.env
-    backend_env = Path(__file__).resolve().parents[1] / ".env"  # backend/.env
+    # A parent process (or a previous import) already loaded the files
+    if os.environ.get("DOTENV_LOADED") == "1":
+        return
     loaded_any = False
-    for p in [root_env, backend_env]:
+    for p in _ENV_CANDIDATES:
         try:
-            if p.exists():
-                load_dotenv(dotenv_path=str(p), override=True)
-                loaded_any = True
+            load_dotenv(dotenv_path=str(p), override=True)
+            loaded_any = True
         except Exception:
             pass
     if not loaded_any:
         # Fallback to default search (current working dir)
         load_dotenv()
+    os.environ["DOTENV_LOADED"] = "1"
+    # settings llm.py derived from the environment before the files were loaded
+    reset_env_cache()
 
 _load_envs()
 
+
+# Read once after .env loading; restart the server to change them
+RAG_MAX_K = int_env("RAG_MAX_K", 6)
+OPENAI_MAX_OUTPUT_TOKENS = int_env("OPENAI_MAX_OUTPUT_TOKENS", 512)
+
 app = FastAPI(title="AI Document Search (RAG Chatbot)")
 
 # Basic logging setup (leverages Uvicorn's handlers if present)
@@ -84,17 +109,45 @@ class IngestRequest(BaseModel):
     metas: list[dict] | None = None
 
 
+# Fast JSON -> UTF-8 bytes: orjson when installed, stdlib otherwise
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+
+def _dumps(obj) -> bytes:
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(obj)
+        except TypeError:
+            # values the stdlib accepts but orjson rejects, e.g. ints beyond 64 bits in metas
+            pass
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+# Pre-encoded SSE framing so the streaming loop yields bytes directly
+_SSE_DATA_PREFIX = b"data: "
+_SSE_END = b"\n\n"
+_SSE_START = b": stream start\n\n"
+_SSE_DONE = b"event: done\ndata: [DONE]\n\n"
+
+
 INDEX = RAGIndex()
+QUERY_CACHE = QueryCache(INDEX)
 
 
 @app.post("/ingest")
-async def ingest(req: IngestRequest):
+async def ingest(req: IngestRequest, background_tasks: BackgroundTasks):
     """Ingest a list of texts (e.g., chunks from PDFs) into the vector store."""
     texts = req.texts or []
     metas = req.metas or [{} for _ in texts]
     if len(texts) != len(metas):
         raise HTTPException(status_code=400, detail="texts and metas length mismatch")
-    INDEX.add_texts(texts, metas)
+    # large ingests are encoded and appended batch by batch
+    await run_in_threadpool(INDEX.add_stream, zip(texts, metas))
+    # persist after the response is sent instead of on every add
+    background_tasks.add_task(INDEX.flush)
     return {"ingested": len(texts)}
 
 
@@ -109,11 +162,7 @@ async def query(message: Message, k: int = 4, use_llm: bool = False, model: str
         from fastapi import Response
         return Response(status_code=429, headers={"Retry-After": str(int(retry_after))}, content=f"Rate limit exceeded. Try again in {retry_after:.1f}s")
     # Clamp k to avoid overly large prompts
-    try:
-        max_k = int(os.getenv("RAG_MAX_K", "6"))
-    except Exception:
-        max_k = 6
-    results = INDEX.query(message.text, k=min(k, max_k))
+    results = await run_in_threadpool(QUERY_CACHE.query, message.text, min(k, RAG_MAX_K))
     # basic telemetry
     try:
         print(f"/query text='{message.text[:80]}' k={k} use_llm={use_llm} model={model} session_id={session_id}")
@@ -132,31 +181,41 @@ async def query(message: Message, k: int = 4, use_llm: bool = False, model: str
         # analytics
         try:
             if user_id:
-                record_query(user_id, llm_used=True)
+                await run_in_threadpool(record_query, user_id, llm_used=True)
         except Exception:
             pass
         return {"results": results, "llm": out}
     # analytics (retrieval only)
     try:
         if user_id:
-            record_query(user_id, llm_used=False)
+            await run_in_threadpool(record_query, user_id, llm_used=False)
     except Exception:
         pass
     return {"results": results}
 
 
 
+def _chunk_pairs(pages: Iterable[str], chunk_size: int, overlap: int, source: str) -> Iterator[tuple[str, dict]]:
+    """Lazily yield (chunk, meta) pairs; consumed by the index's ingest producer."""
+    for i, c in enumerate(chunk_pages(pages, chunk_size=chunk_size, overlap=overlap)):
+        # include text in meta so future rebuilds (e.g., deletions) are possible even with faiss backend
+        yield c, {"source": source, "chunk": i, "text": c}
+
+
 @app.post("/upload")
-async def upload_pdf(file: UploadFile = File(...), chunk_size: int = 500, overlap: int = 50, user_id: str | None = None):
+async def upload_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...), chunk_size: int = 500, overlap: int = 50, user_id: str | None = None):
     """Upload a PDF file, extract text, chunk it and ingest into the index."""
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Only PDF files are supported")
     logger.info("/upload received file='%s' user_id=%s chunk_size=%d overlap=%d", file.filename, user_id, chunk_size, overlap)
     try:
-        data = await file.read()
-        logger.info("/upload read %d bytes from '%s'", len(data or b""), file.filename)
-        text = extract_text_from_pdf_bytes(data)
-        chunks = chunk_text(text, chunk_size=chunk_size, overlap=overlap)
+        # Parse straight from Starlette's spooled temp file instead of copying the body into memory
+        logger.info("/upload size=%s bytes for '%s'", getattr(file, "size", None), file.filename)
+        f = file.file
+        await run_in_threadpool(f.seek, 0)
+        # Opening the PDF is CPU-bound; keep it off the event loop. Parse errors raise
+        # here, while page text is only extracted as the ingest producer pulls it.
+        pages = await run_in_threadpool(iter_pdf_pages, f)
     except ImportError as ie:
         # Missing PDF parser
         logger.exception("PDF parser not available while processing '%s'", file.filename)
@@ -165,16 +224,16 @@ async def upload_pdf(file: UploadFile = File(...), chunk_size: int = 500, overla
         # Return a friendly error instead of letting the server crash
         logger.exception("Failed to parse PDF '%s'", file.filename)
         raise HTTPException(status_code=400, detail=f"Failed to parse PDF: {e}")
-    # include text in meta so future rebuilds (e.g., deletions) are possible even with faiss backend
-    metas = [{"source": file.filename, "chunk": i, "text": chunks[i]} for i in range(len(chunks))]
-    INDEX.add_texts(chunks, metas)
-    logger.info("/upload ingested %d chunks for '%s'", len(chunks), file.filename)
+    # page extraction and chunking run on the index's producer thread while this worker encodes and appends
+    ingested = await run_in_threadpool(INDEX.add_stream, _chunk_pairs(pages, chunk_size, overlap, file.filename))
+    logger.info("/upload ingested %d chunks for '%s'", ingested, file.filename)
     try:
         if user_id:
-            record_upload(user_id)
+            await run_in_threadpool(record_upload, user_id)
     except Exception:
         pass
-    return {"ingested_chunks": len(chunks)}
+    background_tasks.add_task(INDEX.flush)
+    return {"ingested_chunks": ingested}
 
 
 class DeleteRequest(BaseModel):
@@ -183,7 +242,7 @@ class DeleteRequest(BaseModel):
 
 
 @app.delete("/delete")
-async def delete_item(id: int | None = None, source: str | None = None):
+async def delete_item(background_tasks: BackgroundTasks, id: int | None = None, source: str | None = None):
     """Delete indexed items by id (single chunk) or by source (all chunks from a file).
 
     Returns {removed_count} with number of removed chunks.
@@ -192,9 +251,10 @@ async def delete_item(id: int | None = None, source: str | None = None):
         raise HTTPException(status_code=400, detail="Provide id or source")
     try:
         if id is not None:
-            removed = INDEX.remove_by_ids([id])
+            removed = await run_in_threadpool(INDEX.remove_by_ids, [id])
         else:
-            removed = INDEX.remove_by_source(source)  # type: ignore[arg-type]
+            removed = await run_in_threadpool(INDEX.remove_by_source, source)  # type: ignore[arg-type]
+        background_tasks.add_task(INDEX.flush)
         return {"removed_count": removed}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
@@ -203,14 +263,15 @@ async def delete_item(id: int | None = None, source: str | None = None):
 
 
 @app.post("/delete")
-async def delete_item_post(req: DeleteRequest):
+async def delete_item_post(req: DeleteRequest, background_tasks: BackgroundTasks):
     if req.id is None and not req.source:
         raise HTTPException(status_code=400, detail="Provide id or source")
     try:
         if req.id is not None:
-            removed = INDEX.remove_by_ids([req.id])
+            removed = await run_in_threadpool(INDEX.remove_by_ids, [req.id])
         else:
-            removed = INDEX.remove_by_source(req.source or "")
+            removed = await run_in_threadpool(INDEX.remove_by_source, req.source or "")
+        background_tasks.add_task(INDEX.flush)
         return {"removed_count": removed}
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
@@ -230,23 +291,26 @@ async def get_index(summary: bool = True, limit: int = 20):
 
 
 @app.get("/index_grouped")
-async def get_index_grouped():
+async def get_index_grouped(limit: int = 200, offset: int = 0, prefix: str = ""):
     """Return grouped summary by source with total chunk counts.
 
-    Response: { items: [ { source, count }, ... ], total_sources, total_chunks }
+    Sources are sorted by name; use limit/offset to page and prefix to filter.
+    Response: { items: [ { source, count }, ... ], matching_sources, total_sources, total_chunks }
+    (total_* cover the whole index, not just the returned page; matching_sources
+    counts the names that match prefix, so clients can tell where a filtered list ends)
     """
     try:
-        from collections import defaultdict
-        counts: dict[str, int] = defaultdict(int)
-        # iterate all metas
-        metas = INDEX.get_metas(limit=None)
-        for m in metas:
-            s = (m or {}).get('source') or ""
-            counts[str(s)] += 1
-        items = [ { "source": s, "count": c } for s, c in sorted(counts.items(), key=lambda kv: kv[0]) ]
-        return { "items": items, "total_sources": len(items), "total_chunks": sum(counts.values()) }
+        counts = INDEX.sources_summary()
+        limit = max(0, limit)
+        offset = max(0, offset)
+        matching = [(s, c) for s, c in counts.items() if s.startswith(prefix)]
+        # only the first offset+limit names need ordering
+        page = heapq.nsmallest(offset + limit, matching, key=lambda kv: kv[0])[offset:]
+        items = [ { "source": s, "count": c } for s, c in page ]
+        payload = { "items": items, "matching_sources": len(matching), "total_sources": len(counts), "total_chunks": sum(counts.values()) }
+        return Response(content=_dumps(payload), media_type="application/json")
     except Exception:
-        return { "items": [], "total_sources": 0, "total_chunks": 0 }
+        return { "items": [], "matching_sources": 0, "total_sources": 0, "total_chunks": 0 }
 
 
 @app.post("/query_stream")
@@ -259,7 +323,7 @@ async def query_stream(message: Message, k: int = 4, model: str | None = None, r
     if not ok:
         from fastapi import Response
         return Response(status_code=429, headers={"Retry-After": str(int(retry_after))}, content=f"Rate limit exceeded. Try again in {retry_after:.1f}s")
-    results = INDEX.query(message.text, k=k)
+    results = await run_in_threadpool(QUERY_CACHE.query, message.text, k)
 
     def event_gen():
         from .llm import stream_synthesize_answer
@@ -293,49 +357,45 @@ async def query_stream_sse(text: str, k: int = 4, model: str | None = None, requ
     if not ok:
         from fastapi import Response
         return Response(status_code=429, headers={"Retry-After": str(int(retry_after))}, content=f"Rate limit exceeded. Try again in {retry_after:.1f}s")
-    try:
-        max_k = int(os.getenv("RAG_MAX_K", "6"))
-    except Exception:
-        max_k = 6
-    results = INDEX.query(text, k=min(k, max_k))
+    results = await run_in_threadpool(QUERY_CACHE.query, text, min(k, RAG_MAX_K))
     try:
         print(f"/query_stream_sse text='{text[:80]}' k={k} model={model} session_id={session_id} persona={persona}")
     except Exception:
         pass
 
+    # Build the citations/meta frame before streaming so the first bytes go out immediately
+    citations = []
+    for idx, r in enumerate(results, start=1):
+        meta = r.get('meta') or {}
+        preview = (meta.get('text') or '')[:200]
+        citations.append({
+            'n': idx,
+            'source': meta.get('source'),
+            'chunk': meta.get('chunk'),
+            'score': r.get('score'),
+            'preview': preview,
+        })
+    status = llm_status(model)
+    meta_payload = {"citations": citations, "llm_ok": bool(status.get('ok')), "llm_model": status.get('model'), "llm_reason": status.get('reason')}
+    meta_bytes = b"event: meta\n" + _SSE_DATA_PREFIX + _dumps(meta_payload) + _SSE_END
+
     def sse_events():
-        import json as _json
         # Optional: send a kick-off comment to keep some proxies open
-        yield ": stream start\n\n"
+        yield _SSE_START
         # Send citations metadata first
-        citations = []
-        for idx, r in enumerate(results, start=1):
-            meta = r.get('meta') or {}
-            preview = (meta.get('text') or '')[:200]
-            citations.append({
-                'n': idx,
-                'source': meta.get('source'),
-                'chunk': meta.get('chunk'),
-                'score': r.get('score'),
-                'preview': preview,
-            })
-        status = llm_status(model)
-        meta_payload = {"citations": citations, "llm_ok": bool(status.get('ok')), "llm_model": status.get('model'), "llm_reason": status.get('reason')}
-        yield "event: meta\n"
-        yield f"data: {_json.dumps(meta_payload, ensure_ascii=False)}\n\n"
+        yield meta_bytes
         from .llm import stream_synthesize_answer
         full = []
         hist = MEMORY.get_history_messages(session_id, 5) if session_id else None
         # In fast mode, reduce max_tokens for quicker first and overall response
         # Keep responses compact to reduce TPM usage
-        max_toks = 256 if fast else int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "512"))
+        max_toks = 256 if fast else OPENAI_MAX_OUTPUT_TOKENS
         for token in stream_synthesize_answer(text, results, model_override=model, persona=persona, history=hist, max_tokens=max_toks):
             full.append(token)
             # Each event is prefixed with 'data: '
-            yield f"data: {token}\n\n"
+            yield _SSE_DATA_PREFIX + (token if isinstance(token, bytes) else token.encode("utf-8")) + _SSE_END
         # Signal end of stream
-        yield "event: done\n"
-        yield "data: [DONE]\n\n"
+        yield _SSE_DONE
         # store turn after streaming completes
         if session_id:
             try:
@@ -357,13 +417,38 @@ async def query_stream_sse(text: str, k: int = 4, model: str | None = None, requ
     return StreamingResponse(sse_events(), media_type="text/event-stream", headers=headers)
 
 
+def _warmup_sync():
+    """Preload embedder, PDF parser, tokenizer and LLM client; logs per-step timings."""
+    def step(name, fn):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except Exception:
+            pass
+        logger.info("warmup %s took %.1f ms", name, (time.perf_counter() - t0) * 1000)
+
+    step("index", lambda: INDEX.query("warmup", k=1))
+    step("pdf", lambda: extract_text_from_pdf_bytes(b"%PDF-1.4\n%%EOF"))
+    step("chunker", lambda: list(chunk_text("hello world " * 10)))
+    step("llm_client", lambda: (llm_status(), warmup_client()))
+    # Optional: a real 1-token completion (costs a request), off unless WARMUP_LLM=1
+    if flag_env("WARMUP_LLM", False):
+        from .llm import stream_synthesize_answer
+        step("llm_stream", lambda: next(iter(stream_synthesize_answer("warmup", [], max_tokens=1)), None))
+
+
 @app.on_event("startup")
 async def _warmup():
-    """Warm up embeddings/model to reduce first-token latency."""
-    try:
-        _ = INDEX.query("warmup", k=1)
-    except Exception:
-        pass
+    """Warm up models/clients in the background to reduce first-request latency."""
+    # Don't block startup; keep a reference so the task isn't garbage-collected
+    app.state.warmup_task = asyncio.create_task(run_in_threadpool(_warmup_sync))
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    """Release the PDF worker processes and write any pending index changes."""
+    shutdown_pool()
+    await run_in_threadpool(INDEX.flush)
 
 
 @app.get("/profile")
@@ -373,20 +458,21 @@ async def profile(user_id: str | None = None, request: Request = None):
         # fallback to IP-based profile to avoid erroring out
         user_id = (request.client.host if request and request.client else "anonymous")
     try:
-        return get_profile(user_id)
+        return await run_in_threadpool(get_profile, user_id)
     except Exception:
         raise HTTPException(status_code=500, detail="Unable to fetch profile")
 
 
 @app.get("/llm/health")
-async def llm_health(mode: str = "quick", model: str | None = None):
+async def llm_health(mode: str = "quick", model: str | None = None, force: bool = False):
     """Return LLM readiness. mode=quick checks env/SDK only; mode=deep performs a 1-token API call.
+    Results are briefly cached; force=true bypasses the cache.
 
     Response example:
       { "quick": { ok, model, reason }, "deep": { ok, model, reason } }
     """
-    quick = llm_status(model_override=model)
+    quick = llm_status(model_override=model, force=force)
     out = {"quick": quick}
     if (mode or "").lower() in ("deep", "full", "probe"):
-        out["deep"] = ping_llm(model_override=model)
+        out["deep"] = ping_llm(model_override=model, force=force)
     return out
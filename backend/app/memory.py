@@ -1,40 +1,72 @@
-from collections import deque
+import threading
+from collections import OrderedDict, deque
 from typing import Deque, Dict, List, Tuple
 
+from .env import int_env
+
 # Simple in-memory chat memory per session_id
 # Stores pairs of (user, assistant) strings; not persisted.
+# Sessions are kept in LRU order and the least recently used ones are evicted
+# beyond max_sessions so long-running servers don't grow without bound.
 
 _MAX_TURNS_DEFAULT = 5
 
 class SessionMemory:
-    def __init__(self, max_turns: int = _MAX_TURNS_DEFAULT) -> None:
+    def __init__(self, max_turns: int = _MAX_TURNS_DEFAULT, max_sessions: int | None = None) -> None:
         self.max_turns = max_turns
-        self._store: Dict[str, Deque[Tuple[str, str]]] = {}
+        if max_sessions is None:
+            max_sessions = int_env("MEMORY_MAX_SESSIONS", 10000)
+        self.max_sessions = max(1, max_sessions)
+        self._store: "OrderedDict[str, Deque[Tuple[str, str]]]" = OrderedDict()
+        # Prebuilt chat messages per session: (flat messages, start offset of each pair)
+        self._cache: Dict[str, Tuple[Tuple[dict, ...], Tuple[int, ...]]] = {}
+        # streaming handlers touch memory from Starlette's worker threads
+        self._lock = threading.Lock()
 
     def add_turn(self, session_id: str, user_text: str, assistant_text: str) -> None:
         if not session_id:
             return
-        dq = self._store.setdefault(session_id, deque(maxlen=self.max_turns))
-        dq.append((user_text or "", assistant_text or ""))
+        with self._lock:
+            dq = self._store.setdefault(session_id, deque(maxlen=self.max_turns))
+            dq.append((user_text or "", assistant_text or ""))
+            self._cache[session_id] = self._build_messages(dq)
+            self._store.move_to_end(session_id)
+            while len(self._store) > self.max_sessions:
+                evicted, _ = self._store.popitem(last=False)
+                self._cache.pop(evicted, None)
 
-    def get_history_messages(self, session_id: str, limit_pairs: int | None = None) -> List[dict]:
-        """Return a flat list of chat messages alternating user/assistant for the given session.
-        Format matches OpenAI Chat messages: {role, content}.
-        """
-        if not session_id or session_id not in self._store:
-            return []
-        dq = self._store[session_id]
-        pairs = list(dq)[- (limit_pairs or self.max_turns) :]
+    @staticmethod
+    def _build_messages(dq: Deque[Tuple[str, str]]) -> Tuple[Tuple[dict, ...], Tuple[int, ...]]:
         msgs: List[dict] = []
-        for u, a in pairs:
+        starts: List[int] = []
+        for u, a in dq:
+            starts.append(len(msgs))
             if u:
                 msgs.append({"role": "user", "content": u})
             if a:
                 msgs.append({"role": "assistant", "content": a})
-        return msgs
+        return tuple(msgs), tuple(starts)
+
+    def get_history_messages(self, session_id: str, limit_pairs: int | None = None) -> List[dict]:
+        """Return a flat list of chat messages alternating user/assistant for the given session.
+        Format matches OpenAI Chat messages: {role, content}. The message dicts are
+        prebuilt on add_turn and shared between calls; callers must not mutate them.
+        """
+        if not session_id:
+            return []
+        with self._lock:
+            cached = self._cache.get(session_id)
+            if cached is None:
+                return []
+            self._store.move_to_end(session_id)
+        msgs, starts = cached
+        n = limit_pairs or self.max_turns
+        start = starts[-n] if n < len(starts) else 0
+        return list(msgs[start:])
 
     def clear(self, session_id: str) -> None:
-        if session_id in self._store:
-            del self._store[session_id]
+        with self._lock:
+            self._store.pop(session_id, None)
+            self._cache.pop(session_id, None)
 
 MEMORY = SessionMemory()
@@ -0,0 +1,226 @@
+import contextlib
+import importlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from typing import Any, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# ONNX Runtime drop-in for SentenceTransformer.encode (opt-in with RAG_ONNX=1).
+# The model is exported once with optimum-cli, dynamically quantized to INT8 for
+# the host CPU, and run through onnxruntime with mean pooling done here, so no
+# PyTorch forward passes happen at inference time. Sequence length, pooling and
+# normalization come from the model's sentence-transformers config; only
+# Transformer -> mean Pooling [-> Normalize] pipelines are supported. Any failure
+# (missing optimum/onnxruntime, unsupported model) returns None and the caller
+# falls back to sentence-transformers.
+
+_ort: Any | None = None
+try:
+    _ort = importlib.import_module("onnxruntime")
+except Exception:
+    _ort = None
+
+_AutoTokenizer: Any | None = None
+try:
+    _AutoTokenizer = getattr(importlib.import_module("transformers"), "AutoTokenizer", None)
+except Exception:
+    _AutoTokenizer = None
+
+_hf_hub_download: Any | None = None
+try:
+    _hf_hub_download = getattr(importlib.import_module("huggingface_hub"), "hf_hub_download", None)
+except Exception:
+    _hf_hub_download = None
+
+_fcntl: Any | None = None
+try:
+    _fcntl = importlib.import_module("fcntl")
+except Exception:
+    _fcntl = None
+
+logger = logging.getLogger("app.onnx")
+
+_MODEL_FILE = "model.onnx"
+# sentence-transformers pipeline description, copied next to the exported model
+_ST_MODULES = "modules.json"
+_ST_CONFIG = "sentence_bert_config.json"
+_ST_TRANSFORMER = "sentence_transformers.models.Transformer"
+_ST_POOLING = "sentence_transformers.models.Pooling"
+_ST_NORMALIZE = "sentence_transformers.models.Normalize"
+
+
+def _quantize_target() -> str | None:
+    """optimum-cli quantization config matching this CPU, or None to skip quantization."""
+    machine = platform.machine().lower()
+    if machine in ("arm64", "aarch64"):
+        return "--arm64"
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            flags = f.read()
+    except Exception:
+        flags = ""
+    if "avx512_vnni" in flags:
+        return "--avx512_vnni"
+    if "avx512f" in flags:
+        return "--avx512"
+    if "avx2" in flags:
+        return "--avx2"
+    return None
+
+
+def _st_source_file(model_name: str, rel: str) -> Optional[str]:
+    """Path to a sentence-transformers config file of model_name (local dir or Hub id), or None."""
+    if os.path.isdir(model_name):
+        path = os.path.join(model_name, rel)
+        return path if os.path.isfile(path) else None
+    if _hf_hub_download is None:
+        return None
+    try:
+        return _hf_hub_download(model_name, rel)
+    except Exception:
+        return None
+
+
+def _copy_st_config(model_name: str, out_dir: str) -> None:
+    """Copy modules.json, sentence_bert_config.json and the pooling config into out_dir."""
+    modules = _st_source_file(model_name, _ST_MODULES)
+    if modules is None:
+        raise ValueError(f"'{model_name}' has no sentence-transformers {_ST_MODULES}")
+    with open(modules, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    rels = [_ST_MODULES, _ST_CONFIG] + [
+        os.path.join(m["path"], "config.json") for m in entries if m.get("type") == _ST_POOLING
+    ]
+    for rel in rels:
+        src = _st_source_file(model_name, rel)
+        if src is not None:
+            os.makedirs(os.path.dirname(os.path.join(out_dir, rel)), exist_ok=True)
+            shutil.copyfile(src, os.path.join(out_dir, rel))
+
+
+def _st_settings(model_dir: str) -> Tuple[Optional[int], bool]:
+    """(max_seq_length, normalize) from the copied sentence-transformers config.
+
+    Raises ValueError for pipelines this module does not reproduce (CLS/max pooling,
+    Dense layers, ...), so those models stay on sentence-transformers.
+    """
+    with open(os.path.join(model_dir, _ST_MODULES), "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    types = [m.get("type") for m in entries]
+    if types[:2] != [_ST_TRANSFORMER, _ST_POOLING] or any(t != _ST_NORMALIZE for t in types[2:]):
+        raise ValueError(f"unsupported sentence-transformers modules: {types}")
+    with open(os.path.join(model_dir, entries[1]["path"], "config.json"), "r", encoding="utf-8") as f:
+        pooling = json.load(f)
+    modes = [k for k, v in pooling.items() if k.startswith("pooling_mode_") and v]
+    if modes != ["pooling_mode_mean_tokens"]:
+        raise ValueError(f"only mean pooling is supported, got {modes}")
+    max_seq_len = None
+    config = os.path.join(model_dir, _ST_CONFIG)
+    if os.path.exists(config):
+        with open(config, "r", encoding="utf-8") as f:
+            max_seq_len = json.load(f).get("max_seq_length")
+    return max_seq_len, _ST_NORMALIZE in types
+
+
+@contextlib.contextmanager
+def _export_lock(path: str) -> Iterator[None]:
+    """Exclusive file lock, so concurrent workers (or --reload processes) export once."""
+    with open(path, "a") as f:
+        if _fcntl is not None:
+            _fcntl.flock(f, _fcntl.LOCK_EX)
+        # released when the file is closed
+        yield
+
+
+def _export(model_name: str, out_dir: str, quantize: bool) -> None:
+    """Export model_name to out_dir/model.onnx (plus tokenizer and ST config files) with optimum-cli."""
+    # private scratch space: a crashed or concurrent export never touches another one's files
+    work = tempfile.mkdtemp(prefix=os.path.basename(out_dir) + ".", dir=os.path.dirname(out_dir))
+    try:
+        raw_dir = os.path.join(work, "export")
+        os.makedirs(raw_dir)
+        # check the pipeline before spending minutes on an export we could not use
+        _copy_st_config(model_name, raw_dir)
+        _st_settings(raw_dir)
+        # plain transformers export so the graph returns last_hidden_state and pooling stays ours
+        subprocess.run(
+            ["optimum-cli", "export", "onnx", "--model", model_name, "--task", "feature-extraction",
+             "--library-name", "transformers", raw_dir],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        target = _quantize_target() if quantize else None
+        if target is not None:
+            quant_dir = os.path.join(work, "quant")
+            subprocess.run(
+                ["optimum-cli", "onnxruntime", "quantize", target, "--onnx_model", raw_dir, "-o", quant_dir],
+                check=True, stdout=subprocess.DEVNULL,
+            )
+            os.replace(os.path.join(quant_dir, "model_quantized.onnx"), os.path.join(raw_dir, _MODEL_FILE))
+        # publish the finished export in one step so a crash never leaves a half-written model
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.replace(raw_dir, out_dir)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+class OnnxEmbedder:
+    """Subset of the SentenceTransformer encode API backed by an onnxruntime session."""
+
+    def __init__(self, model_dir: str) -> None:
+        # raises ValueError for pipelines that are not Transformer -> mean Pooling [-> Normalize]
+        max_seq_len, self._normalize = _st_settings(model_dir)
+        available = set(_ort.get_available_providers())  # type: ignore[union-attr]
+        providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+        self._session = _ort.InferenceSession(os.path.join(model_dir, _MODEL_FILE), providers=providers)  # type: ignore[union-attr]
+        self._inputs = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = _AutoTokenizer.from_pretrained(model_dir)  # type: ignore[union-attr]
+        # like sentence-transformers: the ST config's max_seq_length, else the tokenizer's limit
+        self._max_seq_len = max_seq_len or self._tokenizer.model_max_length
+
+    def _forward(self, texts: List[str]) -> np.ndarray:
+        enc = self._tokenizer(texts, padding=True, truncation=True, max_length=self._max_seq_len, return_tensors="np")
+        feed = {k: np.asarray(v, dtype=np.int64) for k, v in enc.items() if k in self._inputs}
+        hidden = self._session.run(None, feed)[0]
+        # mean pooling over real (non-padding) tokens
+        mask = feed["attention_mask"][..., None].astype(np.float32)
+        return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = False, **_: Any) -> np.ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        # like sentence-transformers, batch by length so padding inside a batch stays small
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        parts = [self._forward([texts[i] for i in order[s:s + batch_size]]) for s in range(0, len(texts), batch_size)]
+        emb = np.empty((len(texts), parts[0].shape[1]), dtype=np.float32)
+        emb[order] = np.vstack(parts)
+        # the model's Normalize module, or the caller asking for unit vectors
+        if normalize_embeddings or self._normalize:
+            emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        return emb
+
+
+def load_onnx_embedder(model_name: str, cache_dir: str, quantize: bool = True) -> OnnxEmbedder | None:
+    """Return an embedder for model_name, exporting it under cache_dir on first use."""
+    if _ort is None or _AutoTokenizer is None:
+        return None
+    slug = model_name.replace("/", "__") + ("-int8" if quantize else "")
+    model_dir = os.path.join(cache_dir, slug)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with _export_lock(model_dir + ".lock"):
+            # re-checked under the lock: another worker may have finished the export meanwhile
+            if not os.path.exists(os.path.join(model_dir, _MODEL_FILE)):
+                _export(model_name, model_dir, quantize)
+            elif not os.path.exists(os.path.join(model_dir, _ST_MODULES)):
+                # exported before the ST config was copied alongside the model
+                _copy_st_config(model_name, model_dir)
+        return OnnxEmbedder(model_dir)
+    except Exception:
+        logger.warning("ONNX embedder unavailable for '%s'; using sentence-transformers", model_name, exc_info=True)
+        return None
@@ -1,6 +1,15 @@
 import io
+import os
+import atexit
+import multiprocessing
+import re
+import functools
+import threading
 import importlib
-from typing import List, Optional, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+from .env import flag_env, int_env
 
 # Prefer pypdf if available; otherwise lazily try PyPDF2 via importlib to avoid static import errors.
 try:
@@ -15,29 +24,226 @@ if _PdfReader is None:
     except Exception:
         _PdfReader = None
 
+# Optional native BPE tokenizer for token-accurate chunking
+try:
+    _tiktoken: Any = importlib.import_module("tiktoken")
+except Exception:
+    _tiktoken = None
+
+_TIKTOKEN_ENCODING = os.getenv("CHUNK_ENCODING", "cl100k_base")
+# "tokens" (default, needs tiktoken) or "whitespace" (legacy word windows)
+_CHUNK_MODE = os.getenv("CHUNK_MODE", "tokens").lower()
+
+
+# Page-parallel extraction (opt-in via PDF_PARALLEL_PAGES=1). pypdf is pure Python
+# and holds the GIL, so pages are split across worker processes instead of threads.
+_PARALLEL_MIN_PAGES = 4
+_POOL_WORKERS = max(1, int_env("PDF_WORKERS", min(os.cpu_count() or 2, 8)))
+_POOL: Optional[ProcessPoolExecutor] = None
+# guards _POOL: concurrent first uploads would otherwise each start a pool
+_POOL_LOCK = threading.Lock()
+
+
+def _init_worker() -> None:
+    # Pre-import the parser in each worker so the first task doesn't pay for it
+    try:
+        importlib.import_module("pypdf")
+    except Exception:
+        pass
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Return the process-wide executor, created on first use and reused across requests."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn, not fork: forking the threaded server (torch/faiss OpenMP pools, held locks) can deadlock the child
+            _POOL = ProcessPoolExecutor(max_workers=_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker)
+        return _POOL
+
+
+def shutdown_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+
+atexit.register(shutdown_pool)
+
+
+def _extract_pages(data: bytes, start: int, stop: int) -> List[str]:
+    """Worker: reopen the PDF and extract text for pages [start, stop)."""
+    reader = _PdfReader(io.BytesIO(data))  # type: ignore[misc]
+    texts = []
+    for idx in range(start, stop):
+        try:
+            texts.append(reader.pages[idx].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
+
 
 def extract_text_from_pdf_bytes(data: bytes) -> str:
+    return extract_text_from_pdf_stream(io.BytesIO(data))
+
+
+def extract_text_from_pdf_stream(f: BinaryIO) -> str:
+    """Extract text from a seekable binary file object (e.g. an upload's spooled temp file).
+
+    The reader pulls data from the stream on demand instead of requiring one
+    contiguous bytes copy; bytes are only materialized for page-parallel mode.
+    """
+    return "\n".join(iter_pdf_pages(f))
+
+
+def iter_pdf_pages(f: BinaryIO) -> Iterator[str]:
+    """Open the PDF now (so parse errors raise here) and return a lazy iterator of page texts.
+
+    "\n".join() of the pages is extract_text_from_pdf_stream's result; chunk_pages
+    consumes them incrementally, so chunking and ingest start after the first page.
+    """
     if _PdfReader is None:
         raise ImportError("No PDF parser found. Please install 'pypdf' or 'PyPDF2'.")
-    reader = _PdfReader(io.BytesIO(data))
-    texts = []
-    for p in reader.pages:
+    reader = _PdfReader(f)
+    return _iter_pages(f, reader, len(reader.pages))
+
+
+def _iter_pages(f: BinaryIO, reader: Any, n: int) -> Iterator[str]:
+    done = 0
+    if flag_env("PDF_PARALLEL_PAGES", False) and n >= _PARALLEL_MIN_PAGES:
+        pool = _get_pool()
+        # One contiguous page range per worker so the PDF bytes are shipped once per task
+        step = -(-n // _POOL_WORKERS)
+        starts = range(0, n, step)
+        stops = [min(i + step, n) for i in starts]
         try:
-            texts.append(p.extract_text() or "")
+            if isinstance(f, io.BytesIO):
+                data = f.getvalue()
+            else:
+                f.seek(0)
+                data = f.read()
+            # map yields each range in order as soon as it is done
+            for batch in pool.map(_extract_pages, [data] * len(starts), starts, stops):
+                for t in batch:
+                    yield t
+                    done += 1
         except Exception:
-            texts.append("")
-    return "\n".join(texts)
+            # continue sequentially below from the first page not yet yielded (e.g. broken pool)
+            pass
+    for idx in range(done, n):
+        try:
+            yield reader.pages[idx].extract_text() or ""
+        except Exception:
+            yield ""
+
+
+_TOKEN_RE = re.compile(r"\S+")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder() -> Any:
+    """Load the tiktoken encoding once (the first load may fetch the BPE file)."""
+    if _tiktoken is None:
+        return None
+    try:
+        return _tiktoken.get_encoding(_TIKTOKEN_ENCODING)
+    except Exception:
+        return None
 
 
-def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-    """Simple sliding window chunker."""
+def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> Iterator[str]:
+    """Sliding window chunker.
+
+    With tiktoken installed (and CHUNK_MODE != "whitespace") windows are measured
+    in BPE tokens, so chunk_size matches what the LLM sees. Otherwise windows are
+    whitespace-delimited words.
+    """
     if not text:
-        return []
-    tokens = text.split()
-    chunks = []
+        return iter(())
+    return chunk_pages((text,), chunk_size=chunk_size, overlap=overlap)
+
+
+def chunk_pages(pages: Iterable[str], chunk_size: int = 500, overlap: int = 50) -> Iterator[str]:
+    """chunk_text over "\n".join(pages), pulling pages only as the windows need them.
+
+    Windows are yielded as soon as they are complete, so a caller chunking a PDF
+    page by page overlaps extraction with whatever consumes the chunks.
+    """
+    enc = _get_encoder() if _CHUNK_MODE != "whitespace" else None
+    if enc is not None:
+        return _chunk_tokens(enc, pages, chunk_size, overlap)
+    return _chunk_words(pages, chunk_size, overlap)
+
+
+def _joined(pages: Iterable[str]) -> Iterator[str]:
+    # the pieces of "\n".join(pages); a word or character never spans two pieces
+    for i, page in enumerate(pages):
+        yield page if i == 0 else "\n" + page
+
+
+def _token_window(tokens: List[bytes], i: int, j: int) -> str:
+    # BPE tokens are byte sequences and a multibyte character (CJK, emoji) can span
+    # several of them, so decoding a token window could emit U+FFFD at its edges.
+    # Widen the window to whole characters instead; the rest of a character split
+    # at an edge lies in at most 3 neighbouring tokens.
+    head = b"".join(tokens[max(0, i - 3):i])
+    data = head + b"".join(tokens[i:min(len(tokens), j + 3)])
+    start, end = len(head), len(head) + sum(map(len, tokens[i:j]))
+    # back up / run on past UTF-8 continuation bytes (0b10xxxxxx)
+    while start > 0 and data[start] & 0xC0 == 0x80:
+        start -= 1
+    while end < len(data) and data[end] & 0xC0 == 0x80:
+        end += 1
+    # errors="replace" only matters for lone surrogates, which tiktoken already replaced
+    return data[start:end].decode("utf-8", errors="replace")
+
+
+def _chunk_tokens(enc: Any, pages: Iterable[str], chunk_size: int, overlap: int) -> Iterator[str]:
+    step = max(1, chunk_size - overlap)
+    # token bytes from (3 tokens before) the next window's start on; i indexes that start
+    tokens: List[bytes] = []
+    i = 0
+    for piece in _joined(pages):
+        # pieces are encoded separately, so a window's token count can differ by one
+        # at a page seam from encoding the whole document at once
+        tokens.extend(enc.decode_tokens_bytes(enc.encode_ordinary(piece)))
+        while i + chunk_size <= len(tokens):
+            yield _token_window(tokens, i, i + chunk_size)
+            i += step
+        if i > 3:
+            del tokens[:i - 3]
+            i = 3
+    n = len(tokens)
+    # the trailing, possibly shorter windows (the only window for short texts)
+    while i < n:
+        yield _token_window(tokens, i, min(i + chunk_size, n))
+        i += step
+
+
+def _chunk_words(pages: Iterable[str], chunk_size: int, overlap: int) -> Iterator[str]:
+    # Slices of the original string via token offsets (no per-token strings),
+    # so whitespace inside a chunk is preserved as in the source text.
+    step = max(1, chunk_size - overlap)
+    # unconsumed text and its word spans; i indexes the next window's first word
+    text = ""
+    spans: List[Tuple[int, int]] = []
     i = 0
-    while i < len(tokens):
-        chunk = tokens[i:i+chunk_size]
-        chunks.append(" ".join(chunk))
-        i += chunk_size - overlap
-    return chunks
+    for piece in _joined(pages):
+        base = len(text)
+        text += piece
+        spans.extend((s + base, e + base) for s, e in (m.span() for m in _TOKEN_RE.finditer(piece)))
+        while i + chunk_size <= len(spans):
+            yield text[spans[i][0]:spans[i + chunk_size - 1][1]]
+            i += step
+        if i:
+            cut = spans[i][0] if i < len(spans) else len(text)
+            text = text[cut:]
+            spans = [(s - cut, e - cut) for s, e in spans[i:]]
+            i = 0
+    n = len(spans)
+    while i < n:
+        j = min(i + chunk_size, n)
+        yield text[spans[i][0]:spans[j - 1][1]]
+        i += step
@@ -0,0 +1,115 @@
+import os
+import threading
+from typing import Any, List
+
+import numpy as np
+import scipy.sparse as sp
+
+# Approximate (semantic) cache in front of RAGIndex.query.
+# Prior query embeddings are kept L2-normalized in a fixed-size ring buffer; a new
+# query whose cosine similarity to a cached one is above the threshold reuses the
+# cached results instead of running a full index search. The cache is dropped
+# whenever the index version changes (ingest/delete) so results never go stale.
+# Sparse query vectors (TF-IDF path) are cached as CSR rows and compared with one
+# sparse mat-vec, so they never get densified.
+
+_DEFAULT_THRESHOLD = 0.95
+_DEFAULT_MAX = 1024
+
+
+class QueryCache:
+    def __init__(self, index: Any, threshold: float | None = None, max_entries: int | None = None) -> None:
+        self.index = index
+        if threshold is None:
+            try:
+                threshold = float(os.getenv("RAG_CACHE_THRESHOLD", str(_DEFAULT_THRESHOLD)))
+            except Exception:
+                threshold = _DEFAULT_THRESHOLD
+        if max_entries is None:
+            try:
+                max_entries = int(os.getenv("RAG_CACHE_MAX", str(_DEFAULT_MAX)))
+            except Exception:
+                max_entries = _DEFAULT_MAX
+        self.threshold = threshold
+        self.max_entries = max(0, max_entries)
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, version: Any) -> None:
+        self._version = version
+        self._E: np.ndarray | None = None  # (max_entries, dim) float32, rows L2-normalized
+        self._rows: List[Any] = []  # sparse mode: one normalized (1, dim) CSR row per entry
+        self._S: Any | None = None  # sparse mode: _rows stacked, rebuilt lazily after inserts
+        self._sparse = False
+        self._dim = -1
+        self._ks: List[int] = []
+        self._results: List[list] = []
+        self._n = 0
+        self._pos = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self._reset(None)
+
+    def query(self, text: str, k: int = 4) -> list:
+        emb = self.index.embed_query(text)
+        if emb is None or self.max_entries == 0:
+            return self.index.search(emb, k)
+        sparse = sp.issparse(emb)
+        if sparse:
+            q = sp.csr_matrix(emb, dtype=np.float32)
+            norm = float(np.sqrt(q.multiply(q).sum()))
+        else:
+            q = np.asarray(emb, dtype=np.float32).reshape(-1)
+            norm = float(np.linalg.norm(q))
+        if norm == 0.0:
+            return self.index.search(emb, k)
+        q = q * (1.0 / norm)
+        dim = int(q.shape[-1])
+        version = getattr(self.index, "version", None)
+        with self._lock:
+            if version != self._version or self._sparse != sparse or (self._n and self._dim != dim):
+                # index mutated or embedding space changed (e.g. backend switch)
+                self._reset(version)
+            self._sparse, self._dim = sparse, dim
+            if self._n:
+                sims = self._similarities(q)
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold and self._ks[best] >= k:
+                    return self._results[best][:k]
+        results = self.index.search(emb, k)
+        # skip empty results to avoid poisoning the cache
+        if results:
+            with self._lock:
+                if version == self._version:
+                    self._insert(q, k, results)
+        return results
+
+    def _similarities(self, q: Any) -> np.ndarray:
+        if self._sparse:
+            if self._S is None:
+                self._S = sp.vstack(self._rows, format="csr")
+            return np.asarray((self._S @ q.T).todense()).ravel()
+        return self._E[: self._n] @ q  # type: ignore[index]
+
+    def _insert(self, q: Any, k: int, results: list) -> None:
+        slot = self._pos
+        if self._sparse:
+            if slot < len(self._rows):
+                self._rows[slot] = q
+            else:
+                self._rows.append(q)
+            self._S = None
+        else:
+            if self._E is None:
+                self._E = np.zeros((self.max_entries, q.shape[0]), dtype=np.float32)
+            self._E[slot] = q
+        if slot < len(self._results):
+            self._ks[slot] = k
+            self._results[slot] = results
+        else:
+            self._ks.append(k)
+            self._results.append(results)
+        # FIFO eviction via ring buffer
+        self._pos = (slot + 1) % self.max_entries
+        self._n = min(self._n + 1, self.max_entries)
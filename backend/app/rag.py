@@ -1,9 +1,26 @@
 import os
 import json
+import atexit
 import importlib
-from typing import List, Any
+import functools
+import logging
+import queue
+import shutil
+import threading
+import time
+import weakref
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from .embed_cache import EmbeddingCache, content_key
+from .env import flag_env, int_env
+from .onnx_embed import load_onnx_embedder
 
 # Optional dependencies: prefer to resolve at runtime to avoid editor diagnostics when not installed.
 _SentenceTransformer: Any | None = None
@@ -16,6 +33,12 @@ except Exception:
     _SentenceTransformer = None
     _HAS_SENTE = False
 
+_orjson: Any | None = None
+try:
+    _orjson = importlib.import_module("orjson")
+except Exception:
+    _orjson = None
+
 _faiss: Any | None = None
 _HAS_FAISS = False
 try:
@@ -24,311 +47,1131 @@ try:
 except Exception:
     _faiss = None
     _HAS_FAISS = False
-    # sklearn fallback when faiss is not available
-    from sklearn.neighbors import NearestNeighbors
-    from sklearn.feature_extraction.text import TfidfVectorizer
 
 INDEX_PATH = os.path.join(os.path.dirname(__file__), "..", "index")
 EMBED_MODEL_NAME = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
 
 os.makedirs(INDEX_PATH, exist_ok=True)
 
+logger = logging.getLogger("app.rag")
+
+
+# Sentences per model.encode call; sentence-transformers already sorts each call's
+# inputs by length so padding inside a batch stays small.
+EMBED_BATCH = max(1, int_env("EMBED_BATCH", 64))
+
+_torch: Any | None = None
+if _HAS_SENTE:
+    try:
+        _torch = importlib.import_module("torch")
+        # 4-8 intra-op threads is the sweet spot for small encoders on CPU; more mostly adds contention
+        _torch.set_num_threads(max(1, int_env("RAG_TORCH_THREADS", min(8, os.cpu_count() or 1))))
+    except Exception:
+        _torch = None
+
+# RAG_DEVICE: auto (CUDA when available), cpu, cuda, cuda:N, mps. Models on CUDA run
+# in FP16 unless RAG_FP16=0. Ingests of at least RAG_MULTI_GPU_MIN texts fan out
+# across all GPUs on multi-GPU hosts.
+_FP16 = flag_env("RAG_FP16", True)
+_MULTI_GPU_MIN = int_env("RAG_MULTI_GPU_MIN", 2048)
+_EMBED_CACHE = flag_env("RAG_EMBED_CACHE", True)
+# RAG_ONNX=1 runs the embedding model through ONNX Runtime (exported with optimum-cli
+# under INDEX_PATH/onnx on first start, INT8-quantized unless RAG_ONNX_INT8=0).
+_ONNX = flag_env("RAG_ONNX", False)
+_ONNX_INT8 = flag_env("RAG_ONNX_INT8", True)
+
+
+def _embed_device() -> str:
+    device = os.getenv("RAG_DEVICE", "auto").strip().lower()
+    if device not in ("", "auto"):
+        return device
+    try:
+        return "cuda" if _torch is not None and _torch.cuda.is_available() else "cpu"
+    except Exception:
+        return "cpu"
+
+
+def _cuda_device_count() -> int:
+    try:
+        return int(_torch.cuda.device_count()) if _torch is not None else 0
+    except Exception:
+        return 0
+
+
+# Compact vector storage (RAG_COMPACT_VECTORS=1, the default): the faiss HNSW tier
+# keeps 8-bit scalar-quantized codes and the no-faiss dense store keeps float16.
+# Cosine ranking barely moves at that precision; storage and bandwidth drop 2-4x.
+_COMPACT_VECTORS = flag_env("RAG_COMPACT_VECTORS", True)
+
+# Faiss index layout is picked by corpus size: an exact flat scan while small, an
+# HNSW graph above _FAISS_FLAT_MAX vectors and IVF+PQ (coarse lists + compressed
+# codes) above _FAISS_IVFPQ_MIN. Indexes are upgraded in place as the corpus grows.
+# The flat tier stays float32: an SQ8 range trained on the first tiny batch would
+# clip everything added after it, while the HNSW tier trains on >= 1024 vectors.
+_FAISS_FLAT_MAX = 1024
+_FAISS_IVFPQ_MIN = 10_000
+_FAISS_NLIST = 256
+_FAISS_PQ_M = 32
+FAISS_NPROBE = int_env("FAISS_NPROBE", 16)
+FAISS_EF_SEARCH = int_env("FAISS_EF_SEARCH", 64)
+
+
+def _faiss_metric(metric: str) -> int:
+    return _faiss.METRIC_INNER_PRODUCT if metric == "ip" else _faiss.METRIC_L2  # type: ignore[union-attr]
+
+
+def _faiss_tier(n: int, dim: int) -> int:
+    """0 = Flat, 1 = HNSW32,Flat, 2 = IVF-PQ (only when dim splits evenly into PQ sub-vectors)."""
+    if n < _FAISS_FLAT_MAX:
+        return 0
+    if n > _FAISS_IVFPQ_MIN and dim % _FAISS_PQ_M == 0:
+        return 2
+    return 1
+
+
+_FAISS_FACTORY = ("Flat", "HNSW32,SQ8" if _COMPACT_VECTORS else "HNSW32,Flat", f"IVF{_FAISS_NLIST},PQ{_FAISS_PQ_M}")
+# rows per float16 -> float32 block in the dense matmul
+_DOT_BLOCK = 8192
+
+
+def _faiss_inner(index: Any) -> Any:
+    # IndexIDMap2 wraps the index that actually stores and searches the vectors
+    return _faiss.downcast_index(index.index) if hasattr(index, "id_map") else index  # type: ignore[union-attr]
+
+
+def _faiss_has_ids(index: Any) -> bool:
+    # IVF indexes store arbitrary ids natively; Flat/HNSW need the IndexIDMap2 wrapper.
+    # Index files written before either use row positions as ids.
+    return hasattr(index, "id_map") or hasattr(index, "nprobe")
+
+
+def _faiss_index_tier(index: Any) -> int:
+    index = _faiss_inner(index)
+    if hasattr(index, "nprobe"):
+        return 2
+    if hasattr(index, "hnsw"):
+        return 1
+    return 0
+
+
+def _tune_faiss(index: Any) -> None:
+    # search-time knobs; harmless no-ops on index types that lack them
+    index = _faiss_inner(index)
+    if hasattr(index, "nprobe"):
+        index.nprobe = FAISS_NPROBE
+    hnsw = getattr(index, "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = FAISS_EF_SEARCH
+
+
+# Non-chunk bookkeeping keys stored alongside the chunk metas in (legacy) meta.json
+_RESERVED_KEYS = frozenset(("dim", "metric"))
+# Meta keys with their own column; everything else goes to the per-row extras dict
+_COLUMN_KEYS = frozenset(("source", "text"))
+# Files of one metadata generation (INDEX_PATH/columns.<n>/). Also the names of the
+# flat layout that predates columns.json, which kept them directly in INDEX_PATH.
+_IDS_FILE = "ids.npy"
+_COLUMN_FILES = ("sources.json", "texts.json", "extras.json")
+_INFO_FILE = "info.json"
+
+
+# Stateless term hashing for the fallback path: no vocabulary to fit, so new texts
+# are vectorized on their own and appended instead of refitting the whole corpus.
+# l2-normalized rows keep cosine distance equivalent to the old TF-IDF setup.
+# Nothing is fitted, so there is no vocabulary to persist; restarts load the
+# hashed matrix from embeddings.npz (stored uncompressed: ~6x faster to load
+# than zlib npz, and far cheaper than re-hashing the corpus).
+_HASH_FEATURES = 2 ** 18
+
+
+@functools.lru_cache(maxsize=1)
+def _new_vectorizer() -> HashingVectorizer:
+    # stateless, so one instance is shared by every RAGIndex
+    # float32 halves the stored matrix; cosine ranking is unaffected
+    return HashingVectorizer(n_features=_HASH_FEATURES, alternate_sign=False, norm='l2', dtype=np.float32)
+
+
+# Mutations mark files dirty; they are written by flush() (after each ingest/delete
+# request, and at exit) or by the first mutation after changes have been left
+# unsaved for longer than this.
+_SAVE_INTERVAL_S = float(int_env("RAG_SAVE_INTERVAL", 5))
+
+
+def _atomic_write(path: str, write, mode: str = "wb") -> None:
+    """Write via a temp file and os.replace so readers never see a partial file."""
+    tmp = path + ".tmp"
+    if mode == "path":
+        write(tmp)
+    else:
+        with open(tmp, mode, encoding=None if "b" in mode else "utf-8") as f:
+            write(f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Any:
+    with open(path, "rb") as f:
+        data = f.read()
+    return _orjson.loads(data) if _orjson is not None else json.loads(data)
+
+
+def _write_json(path: str, obj: Any) -> None:
+    # compact output: at 10^4+ chunks pretty-printing whitespace dominates the files
+    payload = None
+    if _orjson is not None:
+        try:
+            payload = _orjson.dumps(obj, option=_orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            # values the stdlib accepts but orjson rejects, e.g. ints beyond 64 bits in
+            # metas (orjson reads those back as floats; the index itself stays loadable)
+            payload = None
+    if payload is None:
+        payload = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    _atomic_write(path, lambda f: f.write(payload))
+
+
+# Streaming ingest (RAGIndex.add_stream): a producer task on this process-wide pool
+# chunks and batches the input into a bounded queue while the calling thread
+# encodes the previous batch and appends it to the index as the single writer.
+_INGEST_QUEUE_DEPTH = 4
+_INGEST_WORKERS = max(1, int_env("RAG_INGEST_WORKERS", 4))
+_INGEST_POOL: Optional[ThreadPoolExecutor] = None
+_INGEST_POOL_LOCK = threading.Lock()
+_INGEST_DONE = object()
+
+
+def _get_ingest_pool() -> ThreadPoolExecutor:
+    """Return the process-wide producer pool, created on first use and reused across requests."""
+    global _INGEST_POOL
+    with _INGEST_POOL_LOCK:
+        if _INGEST_POOL is None:
+            _INGEST_POOL = ThreadPoolExecutor(max_workers=_INGEST_WORKERS, thread_name_prefix="rag-ingest")
+        return _INGEST_POOL
+
+
+def _put_until(q: "queue.Queue", item: Any, stop: threading.Event) -> bool:
+    # the consumer sets stop when it bails out, so a full queue never strands the producer
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce_batches(items: Iterable[Tuple[str, dict]], q: "queue.Queue", stop: threading.Event) -> None:
+    """Producer: drain `items` (often a lazy chunk generator) into EMBED_BATCH-sized lists."""
+    try:
+        batch: List[Tuple[str, dict]] = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= EMBED_BATCH:
+                if not _put_until(q, batch, stop):
+                    return
+                batch = []
+        if batch and not _put_until(q, batch, stop):
+            return
+        _put_until(q, _INGEST_DONE, stop)
+    except BaseException as e:
+        # re-raised on the consumer side
+        _put_until(q, e, stop)
+
+
+# Process-wide singletons keyed by what they were built from: embedding models
+# (hundreds of MB, seconds to load), their multi-GPU pools and embedding caches.
+# RAGIndex instances share them, so creating one per request does not reload a model.
+_SHARED_MODEL: Dict[Tuple[str, ...], Any] = {}
+_SHARED_LOCK = threading.Lock()
+
+
+def _shared(key: Tuple[str, ...], factory: Callable[[], Any]) -> Any:
+    with _SHARED_LOCK:
+        if key not in _SHARED_MODEL:
+            _SHARED_MODEL[key] = factory()
+        return _SHARED_MODEL[key]
+
+
+def _load_st_model(model_name: str, device: str) -> Any:
+    model = _SentenceTransformer(model_name, device=device)  # type: ignore[misc]
+    if _FP16 and device.startswith("cuda"):
+        model.half()
+    return model
+
+
+# Writable indexes flushed at exit; weak so instances created per request can be collected
+# (RAGIndex.__del__ writes the unsaved changes of a collected writer)
+_LIVE_INDEXES: "weakref.WeakSet[RAGIndex]" = weakref.WeakSet()
+
+# realpath of an index directory -> token of the instance allowed to write it. Released
+# at the end of the writer's __del__ rather than by a weakref callback, which the cyclic
+# GC runs before finalizers: a reader opened meanwhile would miss the final flush.
+_WRITERS: Dict[str, object] = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def _flush_live_indexes() -> None:
+    for index in list(_LIVE_INDEXES):
+        index.flush()
+
+
+atexit.register(_flush_live_indexes)
+
+
+def _source_key(source: Any) -> str:
+    return str(source or "")
+
+
+def _object_column(values: List[Any]) -> np.ndarray:
+    col = np.empty(len(values), dtype=object)
+    col[:] = values
+    return col
+
+
+def _locked(fn):
+    """Serialize access to the index; handlers call it from worker threads."""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
+class _Backend:
+    """Vector store behind RAGIndex: holds the chunk vectors, searches and persists them.
+
+    Rows line up with RAGIndex's metadata columns. search() returns (distance, key)
+    pairs, lower is better, where key is a chunk id when keyed_by_id, else a row.
+    """
+
+    keyed_by_id = False
+    # "ip" for normalized embeddings; only faiss distinguishes legacy raw L2 vectors
+    metric = "ip"
+    # storage precision recorded in info.json
+    dtype = "float32"
+
+    def load(self, ids: np.ndarray, corpus: Callable[[], List[str]]) -> bool:
+        """Read the persisted vectors; True when they had to be regenerated and need saving."""
+        raise NotImplementedError
+
+    def add(self, vectors: Any, ids: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def reset(self, vectors: Any, ids: np.ndarray) -> None:
+        """Replace the whole store (rebuilds); an empty `vectors` clears it."""
+        raise NotImplementedError
+
+    def remove(self, drop: np.ndarray, ids: np.ndarray) -> bool:
+        """Drop the masked rows (with these ids) in place; False if the caller must rebuild."""
+        raise NotImplementedError
+
+    def search(self, q: Any, k: int) -> List[Tuple[float, int]]:
+        raise NotImplementedError
+
+    def save(self) -> None:
+        raise NotImplementedError
+
+
+class FaissBackend(_Backend):
+    """Faiss index whose ids are the chunk ids, so chunks can be deleted in place."""
+
+    def __init__(self, path: str, metric: str, legacy_embeddings: str | None = None, model_dim: Callable[[], int] | None = None):
+        self.path = path
+        self.metric = metric
+        # embeddings.npy from an sklearn-era index, used to seed a missing index file when
+        # its width matches the model (TF-IDF-era files hold vocabulary-sized rows)
+        self._legacy_embeddings = legacy_embeddings
+        self._model_dim = model_dim
+        self.index: Any | None = None
+        # True while self.index is the read-only memory-mapped file
+        self._mapped = False
+
+    @property
+    def dtype(self) -> str:  # type: ignore[override]
+        tier = _faiss_index_tier(self.index) if self.index is not None else 0
+        if tier == 2:
+            return "pq"
+        if tier == 1 and hasattr(_faiss.downcast_index(_faiss_inner(self.index).storage), "sq"):  # type: ignore[union-attr]
+            return "sq8"
+        return "float32"
+
+    @property
+    def keyed_by_id(self) -> bool:  # type: ignore[override]
+        # index files written before IndexIDMap2 use row positions as ids
+        return self.index is not None and _faiss_has_ids(self.index)
+
+    def load(self, ids, corpus):
+        # only needed for a legacy seed on this first load; not kept, as it is bound to the
+        # owning RAGIndex and would keep it (and its writer claim) alive in a cycle
+        model_dim, self._model_dim = self._model_dim, None
+        if os.path.exists(self.path):
+            try:
+                # IVF lists are served straight from the page cache; other types read normally
+                self.index = _faiss.read_index(self.path, _faiss.IO_FLAG_MMAP | _faiss.IO_FLAG_READ_ONLY)  # type: ignore[union-attr]
+                self._mapped = True
+            except Exception:
+                try:
+                    self.index = _faiss.read_index(self.path)  # type: ignore[union-attr]
+                except Exception:
+                    self.index = None
+            if self.index is not None:
+                _tune_faiss(self.index)
+            return False
+        legacy = self._legacy_embeddings
+        if ids.size and legacy and os.path.exists(legacy):
+            emb = np.load(legacy, mmap_mode='r')
+            dim_ok = emb.ndim == 2 and (model_dim is None or emb.shape[1] == model_dim())
+            if emb.shape[0] == ids.size and dim_ok:
+                emb = np.ascontiguousarray(emb, dtype=np.float32)
+                self.reset(emb, ids)
+                return True
+            logger.warning("Not seeding the faiss index from %s: shape %s, expected %d rows at the model's width; re-ingest to search them",
+                           legacy, emb.shape, ids.size)
+        return False
+
+    def _writable(self):
+        # mapped lists cannot be modified: read the whole file before the first mutation
+        if self._mapped:
+            self.index = _faiss.read_index(self.path)  # type: ignore[union-attr]
+            _tune_faiss(self.index)
+            self._mapped = False
+
+    def _new_index(self, embeddings: np.ndarray):
+        """Create (and train, if needed) an empty faiss index sized for these embeddings.
+
+        IVF keeps ids in its inverted lists; Flat and HNSW are wrapped in IndexIDMap2.
+        (IDMap over IVF would break removal: IVF does not compact its inner ids.)
+        """
+        n, dim = embeddings.shape
+        tier = _faiss_tier(n, dim)
+        index = _faiss.index_factory(dim, _FAISS_FACTORY[tier], _faiss_metric(self.metric))  # type: ignore[union-attr]
+        if tier < 2:
+            index = _faiss.IndexIDMap2(index)  # type: ignore[union-attr]
+        if not index.is_trained:
+            # ~50 points per inverted list is plenty for k-means and PQ codebooks
+            index.train(embeddings[: 50 * _FAISS_NLIST])
+        _tune_faiss(index)
+        return index
+
+    def add(self, vectors, ids):
+        self._writable()
+        if self.index is None:
+            self.index = self._new_index(vectors)
+        if _faiss_has_ids(self.index):
+            self.index.add_with_ids(vectors, ids)
+        else:
+            self.index.add(vectors)
+        ntotal = int(self.index.ntotal)
+        if _faiss_tier(ntotal, self.index.d) > _faiss_index_tier(self.index):
+            # corpus outgrew the current layout: move all vectors into the next tier
+            xb = _faiss_inner(self.index).reconstruct_n(0, ntotal)
+            if hasattr(self.index, "id_map"):
+                xids = _faiss.vector_to_array(self.index.id_map).astype(np.int64)  # type: ignore[union-attr]
+            else:
+                xids = np.arange(ntotal, dtype=np.int64)
+            index = self._new_index(xb)
+            index.add_with_ids(xb, xids)
+            self.index = index
+
+    def reset(self, vectors, ids):
+        self.index = None
+        self._mapped = False
+        if len(vectors):
+            # a fresh index sized for the kept corpus; when empty the next add creates one
+            self.index = self._new_index(vectors)
+            self.index.add_with_ids(vectors, ids)
+
+    def remove(self, drop, ids):
+        # HNSW graphs and positional (legacy) indexes cannot delete
+        if self.index is None or not _faiss_has_ids(self.index):
+            return False
+        self._writable()
+        try:
+            self.index.remove_ids(_faiss.IDSelectorBatch(ids))  # type: ignore[union-attr]
+        except Exception:
+            return False
+        return True
+
+    def search(self, q, k):
+        if self.index is None:
+            return []
+        if self.metric == "ip":
+            # no-op for embed_query output; guards embeddings passed in from elsewhere
+            q = np.ascontiguousarray(q, dtype=np.float32)
+            _faiss.normalize_L2(q)  # type: ignore[union-attr]
+        D, I = self.index.search(q, k)
+        # report cosine distance so lower stays better, as with L2 and the exact backends
+        ip = self.metric == "ip"
+        return [(1.0 - float(d) if ip else float(d), int(i)) for d, i in zip(D[0], I[0]) if i >= 0]
+
+    def save(self):
+        if self.index is not None:
+            _atomic_write(self.path, lambda p: _faiss.write_index(self.index, p), "path")  # type: ignore[union-attr]
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DenseBackend(_Backend):
+    """Exact cosine search over an embedding matrix when faiss is missing.
+
+    Rows are kept unit-normalized (in memory and on disk) so a query is one BLAS
+    matmul plus argpartition for the top k. Normalized embeddings.npy files are
+    memory-mapped read-only on load; add/remove build a fresh in-memory array.
+    Compact storage holds float16 rows, upcast block-wise for the matmul since
+    BLAS only runs in float32/float64.
+    """
+
+    dtype = "float16" if _COMPACT_VECTORS else "float32"
+
+    def __init__(self, path: str, metric: str):
+        self.path = path
+        # legacy "l2" indexes saved raw vectors, which need normalizing on load
+        self.metric = metric
+        self.embeddings: np.ndarray | None = None
+
+    def _normalized(self, embeddings: np.ndarray) -> np.ndarray:
+        emb = np.asarray(embeddings, dtype=np.float32)
+        emb = emb / np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        return emb.astype(self.dtype, copy=False)
+
+    def _set(self, embeddings: np.ndarray | None):
+        self.embeddings = embeddings if embeddings is not None and embeddings.shape[0] else None
+
+    def load(self, ids, corpus):
+        if not os.path.exists(self.path):
+            return False
+        emb = np.load(self.path, mmap_mode='r')
+        if self.metric == "ip" and emb.dtype == self.dtype:
+            # zero-copy: the OS page cache decides which rows stay resident
+            self._set(emb)
+            return False
+        # raw legacy vectors or the other precision: convert and rewrite on the next flush
+        self._set(self._normalized(emb))
+        return True
+
+    def add(self, vectors, ids):
+        vectors = self._normalized(vectors)
+        if self.embeddings is not None:
+            # new vectors only cover this batch: append them
+            vectors = np.vstack([self.embeddings, vectors])
+        self._set(vectors)
+
+    def reset(self, vectors, ids):
+        self._set(self._normalized(vectors))
+
+    def remove(self, drop, ids):
+        if self.embeddings is not None:
+            self._set(self.embeddings[~drop])
+        return True
+
+    def search(self, q, k):
+        if self.embeddings is None:
+            return []
+        q = np.asarray(q, dtype=np.float32).reshape(-1)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        emb = self.embeddings
+        n = emb.shape[0]
+        if emb.dtype == np.float32:
+            sims = emb @ q
+        else:
+            sims = np.empty(n, dtype=np.float32)
+            for s in range(0, n, _DOT_BLOCK):
+                sims[s:s + _DOT_BLOCK] = emb[s:s + _DOT_BLOCK].astype(np.float32) @ q
+        top = np.argpartition(-sims, k)[:k] if k < n else np.arange(n)
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [(1.0 - float(sims[r]), r) for r in top.tolist()]
+
+    def save(self):
+        if self.embeddings is not None:
+            _atomic_write(self.path, lambda f: np.save(f, self.embeddings))
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TfidfBackend(_Backend):
+    """Sparse hashed term vectors searched with sklearn's brute-force cosine kernels."""
+
+    def __init__(self, path: str, vectorizer: HashingVectorizer):
+        self.path = path
+        self._vectorizer = vectorizer
+        self.embeddings: Any | None = None
+        self.nn: NearestNeighbors | None = None
+
+    def _set(self, embeddings: Any | None):
+        self.nn = None
+        self.embeddings = embeddings if embeddings is not None and embeddings.shape[0] else None
+        if self.embeddings is not None:
+            # brute force works on CSR input directly and uses sparse kernels for it
+            self.nn = NearestNeighbors(n_neighbors=min(10, self.embeddings.shape[0]), metric='cosine', algorithm='brute')
+            self.nn.fit(self.embeddings)
+
+    def load(self, ids, corpus):
+        embeddings = None
+        if os.path.exists(self.path):
+            try:
+                embeddings = sp.load_npz(self.path).tocsr()
+            except Exception:
+                embeddings = None
+        if ids.size and (embeddings is None or embeddings.shape != (ids.size, self._vectorizer.n_features)):
+            # missing, stale, or written by the old fitted TfidfVectorizer: re-hash the corpus
+            self._set(self._vectorizer.transform(corpus()))
+            return True
+        if embeddings is not None and embeddings.dtype != self._vectorizer.dtype:
+            # float64 matrices from before the float32 vectorizer
+            self._set(embeddings.astype(self._vectorizer.dtype))
+            return True
+        self._set(embeddings)
+        return False
+
+    def add(self, vectors, ids):
+        if self.embeddings is not None:
+            vectors = sp.vstack([self.embeddings, vectors], format="csr")
+        self._set(vectors)
+
+    def reset(self, vectors, ids):
+        self._set(vectors)
+
+    def remove(self, drop, ids):
+        if self.embeddings is not None:
+            self._set(self.embeddings[np.flatnonzero(~drop)])
+        return True
+
+    def search(self, q, k):
+        if self.nn is None:
+            return []
+        distances, indices = self.nn.kneighbors(q, n_neighbors=min(k, self.embeddings.shape[0]))
+        return [(float(d), int(r)) for d, r in zip(distances[0], indices[0])]
+
+    def save(self):
+        if self.embeddings is not None:
+            _atomic_write(self.path, lambda f: sp.save_npz(f, self.embeddings, compressed=False))
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
 
 class RAGIndex:
-    """RAG index with Faiss if available, otherwise a sklearn NearestNeighbors fallback.
+    """RAG index with Faiss if available, otherwise an exact NumPy/sklearn search fallback.
+
+    Vectors live in one of the _Backend classes, picked once at load. Chunk metadata
+    is held column-wise (ids, sources, texts, extra keys), one file per column. Each
+    flush writes a complete generation directory (columns.<n>/) and then switches the
+    columns.json manifest to it, so a failed flush leaves the previous generation
+    intact. Indexes saved as a single meta.json (renamed to meta.json.migrated) or
+    as flat column files are migrated on load.
+
+    The embedding model, vectorizer and embedding cache are process-wide (see
+    _shared), so instances are cheap to create, e.g. per request or per test; each
+    one still loads its own copy of the index from INDEX_PATH (as it was when the
+    instance was created; later changes to it don't move the instance).
 
-    The class persists embeddings (for sklearn) or faiss index file plus a meta.json mapping.
+    One instance per directory and process writes: the first one opened while no
+    other writer of that directory is alive. Its unsaved changes are flushed when it
+    is garbage-collected, and at exit if it is still alive. Instances opened while a
+    writer is alive are read-only snapshots of what was on disk at that point (True
+    read_only): they serve queries, never write, and raise RuntimeError on add or
+    remove. Use the writer's own instance to see its unsaved changes.
     """
 
     def __init__(self, model_name: str = EMBED_MODEL_NAME):
+        # resolved once: every file of this instance, including later flushes, lives here
+        self._path = INDEX_PATH
         # Fast mode can force TF-IDF even if sentence-transformers is available
-        fast_mode = os.getenv("RAG_FAST", "0") in ("1", "true", "True")
-        # Use sentence-transformers if present and not in fast mode, otherwise TF-IDF fallback
-        if (not fast_mode) and _HAS_SENTE and _SentenceTransformer is not None:
-            self.model = _SentenceTransformer(model_name)
+        fast_mode = flag_env("RAG_FAST", False)
+        # Use the ONNX or sentence-transformers model if present and not in fast mode, otherwise TF-IDF fallback
+        onnx = None
+        if (not fast_mode) and _ONNX:
+            onnx_dir = os.path.join(self._path, "onnx")
+            # a failed export is remembered too (None), so it is not retried per instance
+            onnx = _shared(("onnx", model_name, onnx_dir, str(_ONNX_INT8)), lambda: load_onnx_embedder(model_name, onnx_dir, quantize=_ONNX_INT8))
+        if onnx is not None or ((not fast_mode) and _HAS_SENTE and _SentenceTransformer is not None):
+            self._onnx = onnx is not None
+            if self._onnx:
+                # onnxruntime places the session on CUDA itself when the provider is installed
+                self.device = "cpu"
+                self.model = onnx
+                # INT8 vectors differ slightly from the PyTorch ones, so they get their own cache keys
+                self._model_name = f"{model_name}@onnx{'-int8' if _ONNX_INT8 else ''}"
+            else:
+                self.device = _embed_device()
+                self.model = _shared(("st", model_name, self.device), lambda: _load_st_model(model_name, self.device))
+                self._model_name = model_name
+            # TF-IDF vectors are cheap to recompute, so only model embeddings are cached
+            cache_dir = os.path.join(self._path, "embcache")
+            self._emb_cache = _shared(("embcache", cache_dir), lambda: EmbeddingCache(cache_dir)) if _EMBED_CACHE else None
             self._use_tfidf = False
         else:
             self.model = None
             self._use_tfidf = True
-            self._tfidf = TfidfVectorizer()
-        self.index_file = os.path.join(INDEX_PATH, "faiss.index")
-        self.meta_file = os.path.join(INDEX_PATH, "meta.json")
-        self.embeddings_file = os.path.join(INDEX_PATH, "embeddings.npy")
-        self._load()
-
-    def _load(self):
-        # load meta if exists
-        if os.path.exists(self.meta_file):
-            with open(self.meta_file, "r", encoding="utf-8") as f:
-                self.id_to_meta = json.load(f)
+            self._tfidf = _new_vectorizer()
+        # legacy dict-of-dicts layout; only read when there are no column files
+        self.meta_file = os.path.join(self._path, "meta.json")
+        # {"generation": n}: names the columns.<n> directory that holds the live metadata
+        self.columns_file = os.path.join(self._path, "columns.json")
+        self._generation = 0
+        # bumped on every mutation so callers (e.g. the query cache) can detect stale results
+        self.version = 0
+        self._lock = threading.RLock()
+        self._dirty: set = set()
+        # when the oldest unsaved change was made; None while nothing is dirty
+        self._dirty_since: float | None = None
+        self._view: Dict[str, Any] | None = None
+        self._view_version = -1
+        self._writer_key = os.path.realpath(self._path)
+        self._writer_token = object()
+        with _WRITERS_LOCK:
+            # claimed before loading, so a writer releasing meanwhile has flushed already
+            self.read_only = _WRITERS.setdefault(self._writer_key, self._writer_token) is not self._writer_token
+        try:
+            self._load()
+        except BaseException:
+            self._release_writer()
+            raise
+        if self.read_only:
+            # layout migrations and vector rebuilds found on load are left to the writer
+            self._dirty.clear()
+            self._dirty_since = None
         else:
-            self.id_to_meta = {}
+            _LIVE_INDEXES.add(self)
 
-        if _HAS_FAISS and os.path.exists(self.index_file):
-            try:
-                self.index = _faiss.read_index(self.index_file)  # type: ignore[union-attr]
-                self._use_faiss = True
-            except Exception:
-                self.index = None
-                self._use_faiss = False
-        else:
-            self.index = None
-            self._use_faiss = False
-
-        # sklearn fallback: load embeddings if present
-        if not self._use_faiss and os.path.exists(self.embeddings_file):
-            self.embeddings = np.load(self.embeddings_file)
-            # try to load texts for tfidf
-            self.texts_file = os.path.join(INDEX_PATH, "texts.json")
-            if os.path.exists(self.texts_file):
-                with open(self.texts_file, "r", encoding="utf-8") as f:
-                    try:
-                        self.texts = json.load(f)
-                    except Exception:
-                        self.texts = []
-            else:
-                self.texts = []
-            # ensure TF-IDF vectorizer is fitted to existing corpus for query transforms
+    def __del__(self):
+        # a dropped writer must not take its pending adds/deletes with it
+        if getattr(self, "_dirty", None) and not self.read_only:
             try:
-                if getattr(self, "_use_tfidf", False) and self.texts:
-                    self._tfidf = TfidfVectorizer()
-                    self._tfidf.fit(self.texts)
+                self.flush()
             except Exception:
-                pass
-            # build nn index
-            self._build_sklearn()
-        else:
-            self.embeddings = None
-            self.texts_file = os.path.join(INDEX_PATH, "texts.json")
-            self.texts = []
+                logger.warning("Failed to flush a collected index at %s", self._path, exc_info=True)
+        if hasattr(self, "_writer_token"):
+            self._release_writer()
 
-    def _save_meta(self):
-        with open(self.meta_file, "w", encoding="utf-8") as f:
-            json.dump(self.id_to_meta, f, ensure_ascii=False, indent=2)
+    def _release_writer(self):
+        with _WRITERS_LOCK:
+            if _WRITERS.get(self._writer_key) is self._writer_token:
+                del _WRITERS[self._writer_key]
 
-    def _ensure_faiss(self, dim: int):
-        if self.index is None:
-            self.index = _faiss.IndexFlatL2(dim)  # type: ignore[union-attr]
-            self._use_faiss = True
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"index at {self._path} is opened read-only: another instance in this process writes it")
 
-    def _build_sklearn(self):
-        if self.embeddings is None or len(self.embeddings) == 0:
-            self.nn = None
+    def _load(self):
+        if os.path.exists(self.columns_file):
+            self._generation = int(_read_json(self.columns_file)["generation"])
+            self._load_columns(self._columns_dir(self._generation))
+        elif os.path.exists(os.path.join(self._path, _IDS_FILE)):
+            # flat files written one by one, so a failed flush may have left them uneven
+            self._load_columns(self._path, recover=True)
+            self._dirty.add("meta")
         else:
-            self.nn = NearestNeighbors(n_neighbors=min(10, len(self.embeddings)), metric='cosine')
-            self.nn.fit(self.embeddings)
+            self._load_legacy_meta()
+        # Dense embeddings are L2-normalized and searched by inner product (= cosine).
+        # Indexes written before the 'metric' flag existed hold raw vectors under L2.
+        self._metric = self._info.get('metric') or ("l2" if self._info.get('dim') else "ip")
+        self._recount_sources()
+        self._reset_next_id()
+
+        self._backend = self._new_backend()
+        if self._backend.load(self._ids, self._corpus):
+            self._dirty.add("vectors")
+        if self._dirty:
+            self._dirty_since = time.monotonic()
+
+    def _new_backend(self) -> _Backend:
+        if self._use_tfidf:
+            return TfidfBackend(os.path.join(self._path, "embeddings.npz"), self._tfidf)
+        embeddings_file = os.path.join(self._path, "embeddings.npy")
+        if _HAS_FAISS:
+            return FaissBackend(os.path.join(self._path, "faiss.index"), self._metric, legacy_embeddings=embeddings_file, model_dim=self._model_dim)
+        return DenseBackend(embeddings_file, self._metric)
+
+    def _reset_next_id(self):
+        # ids are never reused while the faiss index deletes in place, so the next id
+        # follows the largest one rather than the chunk count
+        self._next_id = int(self._ids[-1]) + 1 if self._ids.size else 0
+
+    # ---- Column storage ----
+    # Row r describes chunk _ids[r]: _sources[r], _texts[r] and _extras[r] (the
+    # remaining meta keys, or None). _ids stays sorted, so deletes and listings are
+    # NumPy scans/slices and faiss ids map back to rows with a binary search.
+    # Backends store vectors in row order, so exact-search hits index the columns directly.
+
+    def _set_columns(self, ids: np.ndarray, sources: List[Any], texts: List[Any], extras: List[Any]):
+        self._ids = ids
+        self._sources = _object_column(sources)
+        self._texts: List[Any] = texts
+        self._extras: List[Any] = extras
+
+    def _columns_dir(self, generation: int) -> str:
+        return os.path.join(self._path, f"columns.{generation}")
+
+    def _load_columns(self, base: str, recover: bool = False):
+        ids = np.load(os.path.join(base, _IDS_FILE))
+        cols = [_read_json(os.path.join(base, name)) for name in _COLUMN_FILES]
+        if any(len(c) != ids.size for c in cols):
+            if not recover:
+                raise ValueError(f"Index columns in {base} have mismatched lengths; re-ingest required")
+            n = min(ids.size, *(len(c) for c in cols))
+            logger.warning("Index columns in %s have mismatched lengths; keeping the first %d rows", base, n)
+            ids, cols = ids[:n], [c[:n] for c in cols]
+        self._set_columns(ids.astype(np.int64, copy=False), *cols)
+        self._info: Dict[str, Any] = {}
+        info_file = os.path.join(base, _INFO_FILE)
+        if os.path.exists(info_file):
+            self._info = _read_json(info_file)
+
+    def _load_legacy_meta(self):
+        legacy: Dict[str, Any] = {}
+        if os.path.exists(self.meta_file):
+            legacy = _read_json(self.meta_file)
+        self._info = {k: legacy[k] for k in _RESERVED_KEYS if k in legacy}
+        ids = sorted(int(k) for k in legacy if k.isdigit())
+        # one pass splits every meta; zip(*) turns the row tuples into columns
+        split = [self._split_meta(legacy[str(i)] or {}) for i in ids]
+        sources, texts, extras = (list(c) for c in zip(*split)) if split else ([], [], [])
+        self._set_columns(np.array(ids, dtype=np.int64), sources, texts, extras)
+        if ids:
+            # write the columnar files on the next flush
+            self._dirty.add("meta")
+
+    @staticmethod
+    def _split_meta(meta: dict):
+        extra = {k: v for k, v in meta.items() if k not in _COLUMN_KEYS}
+        return meta.get('source'), meta.get('text'), extra or None
+
+    def _meta_at(self, row: int) -> dict:
+        return self._join_meta(self._sources[row], self._texts[row], self._extras[row])
+
+    @staticmethod
+    def _join_meta(source: Any, text: Any, extra: Any) -> dict:
+        meta: Dict[str, Any] = {}
+        if source is not None:
+            meta['source'] = source
+        if extra:
+            meta.update(extra)
+        if text is not None:
+            meta['text'] = text
+        return meta
+
+    def _meta_for_id(self, idx: int) -> dict | None:
+        row = int(np.searchsorted(self._ids, idx))
+        if row < self._ids.size and self._ids[row] == idx:
+            return self._meta_at(row)
+        return None
+
+    def _keep_rows(self, keep: np.ndarray):
+        rows = np.flatnonzero(keep).tolist()
+        self._set_columns(
+            self._ids[keep],
+            self._sources[keep],
+            [self._texts[r] for r in rows],
+            [self._extras[r] for r in rows],
+        )
 
-    def _save_texts(self):
+    def _corpus(self) -> List[str]:
+        return [t or "" for t in self._texts]
+
+    @property
+    @_locked
+    def id_to_meta(self) -> Dict[str, Any]:
+        """Legacy {str(id): meta, 'dim': ..., 'metric': ...} view, rebuilt after mutations. Read-only."""
+        if self._view is None or self._view_version != self.version:
+            view: Dict[str, Any] = {str(i): self._meta_at(r) for r, i in enumerate(self._ids.tolist())}
+            view.update(self._info)
+            self._view, self._view_version = view, self.version
+        return self._view
+
+    def _recount_sources(self):
+        # per-source chunk histogram kept in sync with the source column
+        self._source_counts: Counter = Counter(_source_key(s) for s in self._sources.tolist())
+
+    def _save_meta(self):
+        # next generation after the live one (re-read in case another instance wrote since load)
+        live = int(_read_json(self.columns_file)["generation"]) if os.path.exists(self.columns_file) else 0
+        generation = max(self._generation, live) + 1
+        base = self._columns_dir(generation)
+        # a flush that failed before switching the manifest may have left this behind
+        shutil.rmtree(base, ignore_errors=True)
+        os.makedirs(base)
+        np.save(os.path.join(base, _IDS_FILE), self._ids)
+        for name, column in zip(_COLUMN_FILES, (self._sources.tolist(), self._texts, self._extras)):
+            _write_json(os.path.join(base, name), column)
+        _write_json(os.path.join(base, _INFO_FILE), self._info)
+        # commit point: the manifest names either the old complete generation or this one
+        _write_json(self.columns_file, {"generation": generation})
+        self._generation = generation
+        self._remove_stale_meta()
+
+    def _remove_stale_meta(self):
+        """Best-effort cleanup of older generations and migrated legacy files."""
+        live = os.path.basename(self._columns_dir(self._generation))
         try:
-            with open(self.texts_file, "w", encoding="utf-8") as f:
-                json.dump(self.texts, f, ensure_ascii=False)
-        except Exception:
-            pass
+            for name in os.listdir(self._path):
+                path = os.path.join(self._path, name)
+                if name.startswith("columns.") and name != live and os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif name in (_IDS_FILE, _INFO_FILE, *_COLUMN_FILES):
+                    # flat layout (texts.json also served as the old TF-IDF corpus)
+                    os.remove(path)
+            if os.path.exists(self.meta_file):
+                os.replace(self.meta_file, self.meta_file + ".migrated")
+        except OSError:
+            logger.warning("Could not remove stale index metadata in %s", self._path, exc_info=True)
+
+    def _touch(self, *parts: str):
+        """Mark persisted parts ("vectors", "meta") as changed."""
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        self._dirty.update(parts)
+        # measured from the first unsaved change, so a burst of adds after an idle
+        # period is left to the request's background flush
+        if now - self._dirty_since > _SAVE_INTERVAL_S:
+            self.flush()
+
+    @_locked
+    def flush(self):
+        """Write every dirty part to disk. Cheap no-op when nothing changed.
+
+        A part stays dirty until its write succeeds, so a failed flush is retried
+        by the next one.
+        """
+        if "vectors" in self._dirty:
+            self._backend.save()
+            self._dirty.discard("vectors")
+        if "meta" in self._dirty:
+            self._save_meta()
+            self._dirty.discard("meta")
+        if not self._dirty:
+            self._dirty_since = None
+
+    def _model_dim(self) -> int:
+        """Width of the model's embeddings."""
+        getter = getattr(self.model, "get_sentence_embedding_dimension", None)
+        dim = getter() if getter is not None else None
+        return int(dim) if dim else int(self._encode(["dim"]).shape[1])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        normalize = self._metric == "ip"
+        if not self._onnx and len(texts) >= _MULTI_GPU_MIN and self.device.startswith("cuda") and _cuda_device_count() > 1:
+            emb = np.asarray(self.model.encode_multi_process(texts, self._multi_process_pool(), batch_size=EMBED_BATCH), dtype=np.float32)
+            if normalize:
+                emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+            return emb
+        # normalize_embeddings makes inner product equal to cosine similarity
+        emb = self.model.encode(
+            texts,
+            batch_size=EMBED_BATCH,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+            normalize_embeddings=normalize,
+            device=self.device,
+        )
+        # FP16 models return float16; faiss and sklearn expect float32
+        return np.asarray(emb, dtype=np.float32)
+
+    def _vectorize(self, texts: List[str]) -> Any:
+        """Vectors for new chunks: cached model embeddings, or sparse hashed terms for TF-IDF."""
+        if self._use_tfidf:
+            return self._tfidf.transform(texts)
+        return self._encode_cached(texts)
+
+    def _encode_cached(self, texts: List[str]) -> np.ndarray:
+        """Like _encode, but only runs the model on texts missing from the embedding cache."""
+        cache = self._emb_cache
+        if cache is None or not texts:
+            return self._encode(texts)
+        # the key covers normalization too, since legacy L2 indexes store raw vectors
+        prefix = f"{self._model_name}\x00{self._metric}\x00"
+        keys = [content_key(prefix + t) for t in texts]
+        found = cache.get_many(keys)
+        pending: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                pending.setdefault(k, t)
+        if pending:
+            fresh = self._encode(list(pending.values()))
+            cache.put_many(list(pending), fresh)
+            found.update(zip(pending, fresh))
+        return np.vstack([found[k] for k in keys])
+
+    def _multi_process_pool(self):
+        # one worker per GPU, started on the first large ingest and kept for the process lifetime
+        def start():
+            pool = self.model.start_multi_process_pool()
+            atexit.register(self.model.stop_multi_process_pool, pool)
+            return pool
+        return _shared(("mp_pool", self._model_name, self.device), start)
 
     def add_texts(self, texts: List[str], metas: List[dict]):
+        """Add one batch; it is encoded before the index lock is taken."""
+        self._check_writable()
         if len(texts) == 0:
             return
-        if not self._use_tfidf:
-            embeddings = self.model.encode(texts, convert_to_numpy=True)
-            dim = embeddings.shape[1]
-        else:
-            # maintain a full corpus for TF-IDF so transforms are consistent
-            # load existing texts and append
-            existing_texts = getattr(self, 'texts', []) or []
-            start_id = len(existing_texts)
-            self.texts = existing_texts + texts
-            # re-fit TF-IDF on full corpus
-            self._tfidf = TfidfVectorizer()
-            embeddings = self._tfidf.fit_transform(self.texts).toarray()
-            dim = embeddings.shape[1]
-
-        # if faiss available prefer faiss
-        if _HAS_FAISS and not self._use_tfidf:
-            self._ensure_faiss(dim)
-            self.index.add(embeddings)
-            # write faiss
-            _faiss.write_index(self.index, self.index_file)  # type: ignore[union-attr]
-        else:
-            # embeddings here are the full-corpus embeddings; save them and rebuild nn
-            self.embeddings = embeddings
-            np.save(self.embeddings_file, self.embeddings)
-            # save texts file
-            self._save_texts()
-            self._build_sklearn()
-
-        # assign metas: ensure keys are strings for JSON
-        if not self._use_tfidf:
-            start_id = len([k for k in self.id_to_meta.keys() if k != 'dim'])
-        else:
-            # when using tfidf we appended to texts; the new ids start at previous length
-            start_id = start_id if 'start_id' in locals() else 0
-        for i, m in enumerate(metas):
-            # ensure chunk text is available in meta for LLM context
-            meta = dict(m) if isinstance(m, dict) else {"source": str(m)}
-            # if the texts list exists and we're in TF-IDF mode, use the stored text
-            if self._use_tfidf:
-                try:
-                    meta_text = self.texts[start_id + i]
-                except Exception:
-                    meta_text = None
-            else:
-                # when not tfidf, we received 'texts' parameter originally; assume caller provided text in meta if needed
-                meta_text = meta.get('text')
-            if meta_text:
-                meta['text'] = meta_text
-            self.id_to_meta[str(start_id + i)] = meta
+        # only the new texts need vectorizing
+        self._append(texts, metas, self._vectorize(texts), self._metric)
+
+    def add_stream(self, items: Iterable[Tuple[str, dict]]) -> int:
+        """Ingest (text, meta) pairs in EMBED_BATCH batches; returns the number added.
+
+        Producing the pairs (e.g. extracting and chunking a PDF) overlaps with encoding: a
+        pooled producer fills a queue of at most _INGEST_QUEUE_DEPTH batches. This
+        thread encodes outside the index lock and takes it once per batch to append,
+        so concurrent queries are not stalled by large uploads.
+        """
+        self._check_writable()
+        q: "queue.Queue" = queue.Queue(maxsize=_INGEST_QUEUE_DEPTH)
+        stop = threading.Event()
+        _get_ingest_pool().submit(_produce_batches, items, q, stop)
+        added = 0
+        try:
+            while True:
+                batch = q.get()
+                if batch is _INGEST_DONE:
+                    return added
+                if isinstance(batch, BaseException):
+                    raise batch
+                texts = [t for t, _ in batch]
+                metric = self._metric
+                self._append(texts, [m for _, m in batch], self._vectorize(texts), metric)
+                added += len(batch)
+        finally:
+            stop.set()
+
+    @_locked
+    def _append(self, texts: List[str], metas: List[dict], vectors: Any, metric: str):
+        """Single writer: add pre-computed vectors and their metas under the index lock."""
+        if metric != self._metric:
+            # a rebuild switched the metric while this batch was being encoded
+            vectors = self._vectorize(texts)
+        self.version += 1
+        start_id = self._next_id
+        self._backend.add(vectors, np.arange(start_id, start_id + len(texts), dtype=np.int64))
+
+        # append metas to the columns
+        self._next_id = start_id + len(metas)
+        new_sources, meta_texts, new_extras = zip(*(self._split_meta(m if isinstance(m, dict) else {"source": str(m)}) for m in metas))
+        if self._use_tfidf:
+            # the chunk text is the vectorized text, so keep it for LLM context and rebuilds
+            meta_texts = tuple(t or mt for t, mt in zip(texts, meta_texts))
+        # otherwise assume the caller put the text in meta if needed
+        self._texts.extend(meta_texts)
+        self._extras.extend(new_extras)
+        self._source_counts.update(map(_source_key, new_sources))
+        self._ids = np.concatenate([self._ids, np.arange(start_id, start_id + len(metas), dtype=np.int64)])
+        self._sources = np.concatenate([self._sources, _object_column(new_sources)])
         # save meta and dim
-        self.id_to_meta["dim"] = int(dim)
-        self._save_meta()
+        self._info["dim"] = int(vectors.shape[1])
+        if not self._use_tfidf:
+            self._info["metric"] = self._metric
+            self._info["dtype"] = self._backend.dtype
+        self._touch("meta", "vectors")
 
     # ---- Removal & rebuild helpers ----
-    def _rebuild_from_metas(self, kept_metas: list[dict]):
-        """Rebuild index from kept metas. Requires 'text' in each meta for faiss backend.
+    def _rebuild(self, keep: np.ndarray) -> int:
+        """Rebuild the backend from the kept rows, renumbering ids contiguously.
 
-        For TF-IDF fallback, we rebuild texts corpus and vectorizer.
+        Used when the backend cannot delete in place (legacy positional or HNSW
+        faiss indexes). Requires chunk texts for model embeddings; TF-IDF re-hashes
+        the kept corpus.
         """
-        # Rewrite id_to_meta with contiguous ids
-        new_id_to_meta: dict[str, dict] = {}
-        texts: list[str] = []
-        for new_id, meta in enumerate(kept_metas):
-            m = dict(meta) if isinstance(meta, dict) else {}
-            # Collect text if available
-            t = m.get('text')
-            if t:
-                texts.append(t)
-            new_id_to_meta[str(new_id)] = m
+        rows = np.flatnonzero(keep).tolist()
+        if not self._use_tfidf and not all(self._texts[r] for r in rows):
+            raise ValueError("Cannot rebuild: missing text in metas; re-ingest required")
+        self.version += 1
+        self._keep_rows(keep)
+        self._ids = np.arange(len(rows), dtype=np.int64)
+        self._recount_sources()
+        self._reset_next_id()
 
         if not self._use_tfidf:
-            # For sentence-transformers + faiss path, we need texts
-            if len(texts) != len(kept_metas):
-                raise ValueError("Cannot rebuild: missing text in metas; re-ingest required")
-            embeddings = self.model.encode(texts, convert_to_numpy=True)
-            dim = embeddings.shape[1]
-            # write faiss or sklearn emb as needed
-            if _HAS_FAISS:
-                self._ensure_faiss(dim)
-                # create a fresh index
-                self.index = _faiss.IndexFlatL2(dim)  # type: ignore[union-attr]
-                self.index.add(embeddings)
-                _faiss.write_index(self.index, self.index_file)  # type: ignore[union-attr]
-                self.embeddings = None
-            else:
-                self.embeddings = embeddings
-                np.save(self.embeddings_file, self.embeddings)
-                self._build_sklearn()
-            # clear TF-IDF artifacts since not in use
-            self.texts = []
-            try:
-                if os.path.exists(self.texts_file):
-                    os.remove(self.texts_file)
-            except Exception:
-                pass
-            new_id_to_meta['dim'] = int(dim)
-            self.id_to_meta = new_id_to_meta
-            self._save_meta()
-            return len(kept_metas)
-
-        # TF-IDF fallback: rebuild texts and embeddings
-        self.texts = [m.get('text', '') for m in kept_metas]
-        self._tfidf = TfidfVectorizer()
-        if self.texts:
-            emb = self._tfidf.fit_transform(self.texts).toarray()
+            # everything is re-encoded, so legacy L2 indexes move to normalized inner product here
+            self._metric = self._backend.metric = "ip"
+            self._info['metric'] = self._metric
+        if rows:
+            # kept chunks were embedded on ingest, so this is mostly embedding-cache hits
+            vectors = self._vectorize(self._corpus())
+            self._info['dim'] = int(vectors.shape[1])
         else:
-            emb = np.empty((0, 0))
-        self.embeddings = emb
-        np.save(self.embeddings_file, self.embeddings)
-        self._save_texts()
-        self._build_sklearn()
-        new_id_to_meta['dim'] = int(emb.shape[1] if emb is not None and emb.size else 0)
-        self.id_to_meta = new_id_to_meta
-        self._save_meta()
-        return len(kept_metas)
+            vectors = np.empty((0, int(self._info.get('dim') or 0)), dtype=np.float32)
+        self._backend.reset(vectors, self._ids)
+        if not self._use_tfidf:
+            self._info['dtype'] = self._backend.dtype
+        self._touch("vectors", "meta")
+        return len(rows)
+
+    def _remove_masked(self, drop: np.ndarray) -> int:
+        self._check_writable()
+        removed = int(np.count_nonzero(drop))
+        if removed == 0:
+            return 0
+        if self._backend.remove(drop, self._ids[drop]):
+            # deleted in place, nothing re-encoded; ids are not reused
+            self.version += 1
+            self._source_counts.subtract(map(_source_key, self._sources[drop].tolist()))
+            self._keep_rows(~drop)
+            self._touch("vectors", "meta")
+            return removed
+        before = int(self._ids.size)
+        after = self._rebuild(~drop)
+        return int(before - after)
 
+    @_locked
     def remove_by_ids(self, ids: List[int]) -> int:
         """Remove items by exact integer ids. Returns count removed."""
-        ids_set = set(int(i) for i in ids)
-        kept = []
-        before = 0
-        for k, v in self.id_to_meta.items():
-            if k == 'dim':
-                continue
-            try:
-                idx = int(k)
-            except Exception:
-                continue
-            before += 1
-            if idx in ids_set:
-                continue
-            kept.append(v)
-        after = self._rebuild_from_metas(kept)
-        return int(before - after)
+        wanted = np.asarray(ids, dtype=np.int64).reshape(-1)
+        return self._remove_masked(np.isin(self._ids, wanted))
 
+    @_locked
     def remove_by_source(self, source: str) -> int:
         """Remove all items whose meta.source matches the given source string."""
-        kept = []
-        before = 0
-        for k, v in self.id_to_meta.items():
-            if k == 'dim':
-                continue
-            s = (v or {}).get('source')
-            before += 1
-            if s == source:
-                continue
-            kept.append(v)
-        after = self._rebuild_from_metas(kept)
-        return int(before - after)
+        # elementwise == over the object column, one vectorized pass
+        return self._remove_masked(self._sources == source)
 
-    def query(self, text: str, k: int = 4):
-        # obtain embedding for query depending on backend
+    @_locked
+    def embed_query(self, text: str):
+        """Return the (1, dim) query embedding for the active backend, or None if nothing is searchable."""
         if not self._use_tfidf:
-            emb = self.model.encode([text], convert_to_numpy=True)
-        else:
-            # If no corpus ingested or vectorizer not fitted, there is nothing to search
-            if not getattr(self, 'texts', None):
-                return []
-            # Fit lazily if needed (e.g., after restart)
-            if not hasattr(self._tfidf, 'vocabulary_'):
-                try:
-                    self._tfidf.fit(self.texts)
-                except Exception:
-                    return []
-            emb = self._tfidf.transform([text]).toarray()
-        results = []
-        if self._use_faiss and self.index is not None:
-            D, I = self.index.search(emb, k)
-            for dist, idx in zip(D[0], I[0]):
-                if idx < 0:
-                    continue
-                meta = self.id_to_meta.get(str(idx)) or self.id_to_meta.get(idx)
-                results.append({"score": float(dist), "meta": meta})
-            return results
-
-        # sklearn fallback
-        if self.embeddings is None or getattr(self, 'nn', None) is None:
+            return self._encode([text])
+        # If no corpus ingested, there is nothing to search
+        if not self._ids.size:
+            return None
+        # (1, n_features) sparse row; the hashing vectorizer needs no fitting
+        return self._tfidf.transform([text])
+
+    @_locked
+    def search(self, emb, k: int = 4):
+        """Nearest-neighbour search for an embedding produced by embed_query()."""
+        if emb is None:
             return []
-        distances, indices = self.nn.kneighbors(emb, n_neighbors=min(k, len(self.embeddings)))
-        for dist, idx in zip(distances[0], indices[0]):
-            meta = self.id_to_meta.get(str(idx))
-            results.append({"score": float(dist), "meta": meta})
-        return results
+        backend = self._backend
+        meta_of = self._meta_for_id if backend.keyed_by_id else self._meta_at
+        return [{"score": score, "meta": meta_of(key)} for score, key in backend.search(emb, k)]
+
+    def query(self, text: str, k: int = 4):
+        return self.search(self.embed_query(text), k)
 
+    @_locked
     def get_metas(self, limit: int | None = None):
         """Return list of stored metas (as dicts). If limit is set, return that many."""
-        # id_to_meta stores numeric keys as strings and a 'dim' key
-        metas = []
-        for k, v in self.id_to_meta.items():
-            if k == 'dim':
-                continue
-            try:
-                idx = int(k)
-            except Exception:
-                continue
-            metas.append({"id": idx, **(v or {})})
-        metas.sort(key=lambda x: x.get('id', 0))
-        if limit is not None:
-            return metas[:limit]
-        return metas
+        # the id column is sorted, so slicing it gives the first `limit` ids directly
+        ids = self._ids if limit is None else self._ids[:limit]
+        return [{"id": i, **self._meta_at(r)} for r, i in enumerate(ids.tolist())]
+
+    def iter_metas(self) -> Iterator[dict]:
+        """Iterate stored metas (without ids) without materializing a list.
+
+        Yields a snapshot: mutations swap in new columns or append past its end,
+        so concurrent adds/removes don't show up in (or break) a running iteration.
+        """
+        with self._lock:
+            n = self._ids.size
+            sources, texts, extras = self._sources, self._texts, self._extras
+        for r in range(n):
+            yield self._join_meta(sources[r], texts[r], extras[r])
+
+    @_locked
+    def sources_summary(self) -> Dict[str, int]:
+        """Return {source: chunk_count}, maintained incrementally on add/remove."""
+        return {s: c for s, c in self._source_counts.items() if c > 0}
 
+    @_locked
     def count(self):
         """Return number of indexed chunks."""
-        return len([k for k in self.id_to_meta.keys() if k != 'dim'])
+        return int(self._ids.size)
@@ -1,9 +1,113 @@
+import functools
+import os
+import threading
 import time
-from typing import Tuple
+from collections import OrderedDict
+from typing import List, Tuple
 
+from .env import int_env
 
-# Simple in-memory token bucket per IP. Not for multi-process or production use.
-_buckets = {}
+
+# Simple in-memory rate limiting per IP. Not for multi-process or production use.
+# RL_ALGO selects the algorithm once at import:
+#   token   - token bucket (default); allows a full-capacity burst after idling
+#   sliding - sliding window counter; smooths bursts across window boundaries
+RL_ALGO = os.getenv("RL_ALGO", "token").strip().lower()
+# Per-IP state is kept in LRU order; the least recently seen IPs are dropped
+# beyond RL_MAX_IPS so the tables stay bounded.
+RL_MAX_IPS = max(1, int_env("RL_MAX_IPS", 10000))
+
+# ip -> [tokens, last_refill]; mutated in place
+_buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=32)
+def _refill_rate(capacity: int, per_seconds: int) -> float:
+    return capacity / per_seconds
+
+
+def _token_bucket_allow(ip: str, capacity: int = 60, per_seconds: int = 60, cost: int = 1) -> Tuple[bool, float, int]:
+    now = time.monotonic()
+    rate = _refill_rate(capacity, per_seconds)
+    with _lock:
+        bucket = _buckets.get(ip)
+        if bucket is None:
+            if len(_buckets) >= RL_MAX_IPS:
+                _buckets.popitem(last=False)
+            bucket = _buckets[ip] = [float(capacity), now]
+        else:
+            _buckets.move_to_end(ip)
+        # refill
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= cost:
+            tokens -= cost
+            bucket[0] = tokens
+            return True, 0.0, int(tokens)
+        bucket[0] = tokens
+    # not enough tokens: compute wait time
+    needed = cost - tokens
+    retry_after = needed / rate
+    return False, retry_after, int(tokens)
+
+
+class SlidingWindowCounter:
+    """Sliding window counter: the previous window's count is weighted by how much
+    of it still overlaps the trailing per_seconds interval."""
+
+    def __init__(self, max_ips: int = RL_MAX_IPS) -> None:
+        # ip -> [prev_count, curr_count, window_start], in LRU order
+        self._windows: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._max_ips = max_ips
+        self._lock = threading.Lock()
+
+    def allow(self, ip: str, capacity: int = 60, per_seconds: int = 60, cost: int = 1) -> Tuple[bool, float, int]:
+        with self._lock:
+            return self._allow_locked(ip, capacity, per_seconds, cost)
+
+    def _allow_locked(self, ip: str, capacity: int, per_seconds: int, cost: int) -> Tuple[bool, float, int]:
+        now = time.monotonic()
+        w = self._windows.get(ip)
+        if w is None:
+            if len(self._windows) >= self._max_ips:
+                self._windows.popitem(last=False)
+            w = self._windows[ip] = [0.0, 0.0, now]
+        else:
+            self._windows.move_to_end(ip)
+        prev, curr, start = w
+        elapsed = now - start
+        if elapsed >= per_seconds:
+            # roll forward; if more than one window passed, the previous one is empty
+            passed = int(elapsed // per_seconds)
+            prev = curr if passed == 1 else 0.0
+            curr = 0.0
+            start += passed * per_seconds
+            elapsed = now - start
+        weighted = prev * (1.0 - elapsed / per_seconds) + curr
+        if weighted + cost <= capacity:
+            curr += cost
+            w[0], w[1], w[2] = prev, curr, start
+            return True, 0.0, int(capacity - weighted - cost)
+        w[0], w[1], w[2] = prev, curr, start
+        # wait until enough of the previous window has slid out...
+        excess = weighted + cost - capacity
+        until_roll = per_seconds - elapsed
+        if prev > 0 and excess * per_seconds / prev <= until_roll:
+            retry_after = excess * per_seconds / prev
+        else:
+            # ...or past the roll, where curr becomes the fully weighted previous window
+            # and has to decay until the request fits
+            post_excess = curr + cost - capacity
+            if post_excess <= 0:
+                retry_after = until_roll
+            else:
+                retry_after = until_roll + per_seconds * min(1.0, post_excess / curr if curr > 0 else 1.0)
+        return False, retry_after, max(0, int(capacity - weighted))
+
+
+_sliding = SlidingWindowCounter()
+_allow_impl = _sliding.allow if RL_ALGO == "sliding" else _token_bucket_allow
 
 
 def allow(ip: str, capacity: int = 60, per_seconds: int = 60, cost: int = 1) -> Tuple[bool, float, int]:
@@ -13,17 +117,4 @@ def allow(ip: str, capacity: int = 60, per_seconds: int = 60, cost: int = 1) ->
     per_seconds: refill window for the full capacity
     cost: tokens required for this request
     """
-    now = time.monotonic()
-    rate = capacity / per_seconds
-    tokens, last = _buckets.get(ip, (capacity, now))
-    # refill
-    tokens = min(capacity, tokens + (now - last) * rate)
-    if tokens >= cost:
-        tokens -= cost
-        _buckets[ip] = (tokens, now)
-        return True, 0.0, int(tokens)
-    # not enough tokens: compute wait time
-    needed = cost - tokens
-    retry_after = needed / rate
-    _buckets[ip] = (tokens, now)
-    return False, retry_after, int(tokens)
+    return _allow_impl(ip, capacity, per_seconds, cost)
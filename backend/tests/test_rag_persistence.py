@@ -0,0 +1,130 @@
+import gc
+import json
+import os
+
+import pytest
+
+from backend.app import rag
+from backend.app.rag import RAGIndex
+
+
+@pytest.fixture
+def new_index(monkeypatch):
+    # TF-IDF keeps the test independent of model downloads
+    monkeypatch.setenv("RAG_FAST", "1")
+
+    def new(path):
+        monkeypatch.setattr(rag, "INDEX_PATH", str(path))
+        return RAGIndex()
+
+    return new
+
+
+def _rows(idx):
+    return [(m["id"], m.get("source"), m.get("text"), m.get("chunk")) for m in idx.get_metas()]
+
+
+def test_legacy_meta_migrates_and_reloads(tmp_path, new_index):
+    legacy = {
+        "0": {"source": "a.pdf", "chunk": 0, "text": "The capital of France is Paris."},
+        "1": {"source": "b.pdf", "chunk": 0, "text": "Python is a programming language."},
+    }
+    (tmp_path / "meta.json").write_text(json.dumps(legacy), encoding="utf-8")
+
+    idx = new_index(tmp_path)
+    assert idx.count() == 2
+    idx.flush()
+    # migrated to one column generation; the old file is kept aside, not read again
+    assert (tmp_path / "columns.json").exists()
+    assert not (tmp_path / "meta.json").exists()
+    assert (tmp_path / "meta.json.migrated").exists()
+
+    # mutate, flush, reload
+    idx.add_texts(["Cats are mammals."], [{"source": "c.pdf", "chunk": 0}])
+    assert idx.remove_by_source("b.pdf") == 1
+    expected = _rows(idx)
+    idx.flush()
+    reloaded = new_index(tmp_path)
+    assert _rows(reloaded) == expected
+    assert reloaded.query("capital of France", k=1)[0]["meta"]["source"] == "a.pdf"
+    # only the live generation is left on disk
+    assert [n for n in os.listdir(tmp_path) if n.startswith("columns.") and n != "columns.json"] == [
+        f"columns.{reloaded._generation}"
+    ]
+
+
+def test_failed_flush_keeps_previous_generation(tmp_path, new_index, monkeypatch):
+    idx = new_index(tmp_path)
+    idx.add_texts(["first chunk"], [{"source": "a"}])
+    idx.flush()
+    before = _rows(idx)
+
+    idx.add_texts(["second chunk"], [{"source": "b"}])
+    write_json = rag._write_json
+
+    def failing(p, obj):
+        if p.endswith("extras.json"):
+            raise OSError("disk full")
+        write_json(p, obj)
+
+    monkeypatch.setattr(rag, "_write_json", failing)
+    with pytest.raises(OSError):
+        idx.flush()
+    monkeypatch.setattr(rag, "_write_json", write_json)
+    # the vectors were saved before the failure; the columns stay at the previous generation
+    assert _rows(new_index(tmp_path)) == before
+    assert "meta" in idx._dirty
+
+    idx.flush()
+    assert len(_rows(new_index(tmp_path))) == 2
+
+
+def test_dropped_instance_keeps_its_adds(tmp_path, new_index):
+    def ingest():
+        # never flushed explicitly, like a per-request instance
+        idx = new_index(tmp_path)
+        idx.add_texts(["a chunk", "another chunk"], [{"source": "a"}, {"source": "b"}])
+        assert idx.count() == 2
+
+    ingest()
+    gc.collect()
+    assert new_index(tmp_path).count() == 2
+
+
+def test_flush_writes_where_the_index_was_loaded(tmp_path, new_index, monkeypatch):
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    idx = new_index(first)
+    idx.add_texts(["a chunk"], [{"source": "a"}])
+    # e.g. another test (or a reload) repointing the module path
+    monkeypatch.setattr(rag, "INDEX_PATH", str(second))
+    idx.add_texts(["another chunk"], [{"source": "b"}])
+    idx.flush()
+
+    assert new_index(first).count() == 2
+    assert not [n for n in os.listdir(second) if n.startswith("columns.")]
+
+
+def test_second_instance_is_read_only(tmp_path, new_index):
+    writer = new_index(tmp_path)
+    writer.add_texts(["a chunk"], [{"source": "a"}])
+    writer.flush()
+
+    reader = new_index(tmp_path)
+    assert reader.read_only and not writer.read_only
+    assert reader.count() == 1
+    with pytest.raises(RuntimeError):
+        reader.add_texts(["stale"], [{"source": "x"}])
+    with pytest.raises(RuntimeError):
+        reader.remove_by_source("a")
+
+    # dropping the stale snapshot must not roll back the writer's later changes
+    writer.add_texts(["another chunk"], [{"source": "b"}])
+    del reader
+    gc.collect()
+    del writer
+    gc.collect()
+    reopened = new_index(tmp_path)
+    assert not reopened.read_only
+    assert reopened.count() == 2